@@ -41,3 +41,4 @@ INLINE = Flag.INLINE
 COMMON = Flag.COMMON
 REGEX = Flag.REGEX
 OPTIMIZE = Flag.OPTIMIZE
+SPECIALIZE = Flag.SPECIALIZE
@@ -11,11 +11,15 @@ def autoignore(grammar: Grammar, ignore: Optional[Definition]) -> Grammar:
     """Interleave ignore patterns around sequence items."""
     if ignore is not None:
         ignore = disarm(ignore)
+    defs = grammar.definitions
     new = {
         name: _autoignore(defn, ignore)
         for name, defn
-        in grammar.definitions.items()
+        in defs.items()
     }
+    # without any autoignore definitions there is nothing to rebuild
+    if all(new[name] is defs[name] for name in defs):
+        return grammar
     return Grammar(
         definitions=new,
         actions=grammar.actions,
@@ -40,12 +44,14 @@ def _autoignore(defn: Definition, ignore: Optional[Definition]) -> Definition:
     elif op.type == 'Primary':
         pass
     elif op.is_unary():
+        # only rebuild when a subexpression changed
         args = defn.args
-        defn = Definition(op, (_autoignore(args[0], ignore), *args[1:]))
+        subdef = _autoignore(args[0], ignore)
+        if subdef is not args[0]:
+            defn = Definition(op, (subdef, *args[1:]))
     else:
         args = defn.args
-        defn = Definition(
-            op,
-            ([_autoignore(arg, ignore) for arg in args[0]], *args[1:])
-        )
+        subdefs = [_autoignore(arg, ignore) for arg in args[0]]
+        if any(new is not old for new, old in zip(subdefs, args[0])):
+            defn = Definition(op, (subdefs, *args[1:]))
     return defn
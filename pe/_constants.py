@@ -56,4 +56,5 @@ class Flag(enum.Flag):
     INLINE = _auto()  # inline non-recursive rules
     COMMON = _auto()  # replace common idioms with faster alternatives
     REGEX = _auto()  # combine adjacent terms into a single regex
+    SPECIALIZE = _auto()  # generate code for unstructured expressions
     OPTIMIZE = INLINE | COMMON | REGEX
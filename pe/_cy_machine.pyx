@@ -7,19 +7,21 @@ Inspired by Medeiros and Ierusalimschy, 2008, "A Parsing Machine for PEGs"
 """
 
 from typing import Union, Tuple, List, Dict, Optional, Any
-import re
 from enum import IntEnum
 
-from cpython.mem cimport PyMem_Malloc, PyMem_Free
+from cpython.mem cimport PyMem_Malloc, PyMem_Realloc, PyMem_Free
+from libc.string cimport memcpy
 
-from pe._constants import Operator, Flag, FAIL as FAILURE
+from pe._constants import (
+    Operator, Flag, FAIL as FAILURE, MAX_MEMO_SIZE, DEL_MEMO_SIZE
+)
 from pe._errors import Error, ParseError
 from pe._match import Match
 from pe._types import Memo
 from pe._definition import Definition
 from pe._grammar import Grammar
 from pe._parser import Parser
-from pe._optimize import optimize
+from pe._optimize import optimize, compile_regex, retried
 from pe._autoignore import autoignore
 from pe.actions import Action, Bind
 from pe.operators import Rule
@@ -50,37 +52,66 @@ cdef struct State:
     int mark
     int argidx
     int kwidx
-    State* prev
+
+
+# States are pushed and popped for nearly every instruction, so each
+# match keeps them in one array that is indexed by the top of the
+# stack and doubled when it is full, instead of allocating each state.
+# The array starts in the match's own C frame, so only matches that
+# backtrack deeply allocate it on the heap.
+cdef enum:
+    INITIAL_STACK_SIZE = 256
+
+
+cdef struct Stack:
+    State* states
+    int size
+    int top  # -1 when empty
+    bint heap  # whether states was allocated
 
 
 cdef State* push(
+    Stack* stack,
     int opidx,
     int pos,
     int count,
     int mark,
     int argidx,
     int kwidx,
-    State* prev
 ) except NULL:
-    cdef State* state = <State*>PyMem_Malloc(sizeof(State))
-    if not state:
-        raise MemoryError()
+    cdef State* states
+    if stack.top + 1 == stack.size:
+        if stack.heap:
+            states = <State*>PyMem_Realloc(
+                stack.states, 2 * stack.size * sizeof(State)
+            )
+        else:
+            states = <State*>PyMem_Malloc(2 * stack.size * sizeof(State))
+            if states:
+                memcpy(states, stack.states, stack.size * sizeof(State))
+        if not states:
+            raise MemoryError()
+        stack.states = states
+        stack.size *= 2
+        stack.heap = True
+    stack.top += 1
+    cdef State* state = &stack.states[stack.top]
     state.opidx = opidx
     state.pos = pos
     state.count = count
     state.mark = mark
     state.argidx = argidx
     state.kwidx = kwidx
-    state.prev = prev
     return state
 
 
-cdef State* pop(State* state) except? NULL:
-    if not state:
+cdef State* pop(Stack* stack) except? NULL:
+    if stack.top < 0:
         raise Error('pop from empty stack')
-    cdef State* prev = state.prev
-    PyMem_Free(state)
-    return prev
+    stack.top -= 1
+    if stack.top < 0:
+        return NULL
+    return &stack.states[stack.top]
 
 
 _Binding = Tuple[str, Any]
@@ -101,9 +132,9 @@ cdef class Scanner:
 cdef class Instruction:
     cdef public:
         OpCode opcode
-        short oploc
+        int oploc
         Scanner scanner
-        short maxcount
+        int maxcount
         bint marking
         bint capturing
         object action
@@ -112,9 +143,9 @@ cdef class Instruction:
     def __init__(
         self,
         OpCode opcode,
-        short oploc=1,
+        int oploc=1,
         Scanner scanner=None,
-        short maxcount=1,
+        int maxcount=1,
         bint marking=False,
         bint capturing=False,
         object action=None,
@@ -158,13 +189,28 @@ class MachineParser(Parser):
                            inline=flags & Flag.INLINE,
                            common=flags & Flag.COMMON,
                            regex=False)
+        # Regexes cost more per call than the compiled scanners, so they
+        # are only used when the whole start rule becomes one regex.
+        if flags & Flag.REGEX:
+            modified = optimize(grammar, inline=False, common=False, regex=True)
+            if modified[modified.start].op == Operator.RGX:
+                grammar = modified
         # if flags & Flag.DEBUG:
         #     grammar = debug(grammar)
         self.modified_grammar = grammar
 
         pi, index = _make_program(grammar)
-        self._parser = _Parser(pi)
+        # memoization only pays for rules that may be tried again at the
+        # same position, and not for those that are a single scan
+        self._memoized = {
+            index[name] for name in retried(grammar.definitions)
+            if not (pi[index[name]].opcode == SCAN
+                    and pi[index[name] + 1].opcode == RETURN)
+        }
+        self._parser = _Parser(pi, self._memoized)
         self._index = index
+        self._start_idx = index[grammar.start]
+        self._start_defn = self.grammar[self.start]
 
     @property
     def start(self):
@@ -178,10 +224,11 @@ class MachineParser(Parser):
               int pos = 0,
               flags: Flag = Flag.NONE) -> Union[Match, None]:
         memo: Union[Memo, None] = None
+        if flags & Flag.MEMOIZE and self._memoized:
+            memo = {}
         args: List[Any] = []
         kwargs: List[_Binding] = []
-        idx = self._index[self.start]
-        end = self._parser.match(idx, s, pos, args, kwargs, memo)
+        end = self._parser.match(self._start_idx, s, pos, args, kwargs, memo)
         if end < 0:
             if flags & Flag.STRICT:
                 raise ParseError()
@@ -191,17 +238,19 @@ class MachineParser(Parser):
                 s,
                 pos,
                 end,
-                self.grammar[self.start],
-                args,
-                dict(kwargs)
+                self._start_defn,
+                tuple(args) if args else None,
+                dict(kwargs) if kwargs else None,
             )
 
 
 cdef class _Parser:
     cdef list pi
+    cdef set memoized
 
-    def __init__(self, list pi):
+    def __init__(self, list pi, set memoized):
         self.pi = pi
+        self.memoized = memoized
 
     cpdef int match(
         self,
@@ -212,19 +261,23 @@ cdef class _Parser:
         list kwargs,
         dict memo,
     ) except -2:
-        cdef State* state
-        cdef int retval = -1
-        state = push(0, 0, 0, -1, 0, 0, NULL)     # failure (top backtrack entry)
-        state = push(-1, -1, 1, -1, 0, 0, state)  # success
+        if s is None or args is None or kwargs is None:
+            raise TypeError
+        cdef State initial[INITIAL_STACK_SIZE]
+        cdef Stack stack
+        stack.states = initial
+        stack.size = INITIAL_STACK_SIZE
+        stack.top = -1
+        stack.heap = False
         try:
-            state = self._match(idx, s, pos, args, kwargs, memo, state)
-            retval = state.pos
+            push(&stack, 0, 0, 0, -1, 0, 0)     # failure (top backtrack entry)
+            push(&stack, -1, -1, 0, -1, 0, 0)  # success
+            return self._match(idx, s, pos, args, kwargs, memo, &stack)
         finally:
-            while state:
-                state = pop(state)
-        return retval
+            if stack.heap:
+                PyMem_Free(stack.states)
 
-    cdef State* _match(
+    cdef int _match(
         self,
         int idx,
         str s,
@@ -232,24 +285,19 @@ cdef class _Parser:
         list args,
         list kwargs,
         dict memo,
-        State* state,
-    ) except NULL:
-        if s is None:
-            raise TypeError
-        if args is None:
-            raise TypeError
-        if kwargs is None:
-            raise TypeError
+        Stack* stack,
+    ) except -2:
         # lookup optimizations
-        pi = self.pi
+        cdef list pi = self.pi
         # cdef OpCode opcode
         cdef int slen = len(s)
         cdef Instruction instr
+        cdef State* state = &stack.states[stack.top]
         while state:
-            instr = pi[idx]
+            instr = <Instruction>pi[idx]
 
             if instr.marking:
-                state = push(0, -1, 0, pos, len(args), len(kwargs), state)
+                state = push(stack, 0, -1, 0, pos, len(args), len(kwargs))
 
             if instr.opcode == SCAN:
                 pos = instr.scanner._scan(s, pos, slen)
@@ -257,45 +305,74 @@ cdef class _Parser:
                     idx = FAILURE
 
             elif instr.opcode == BRANCH:
-                state = push(idx + instr.oploc, pos, 0, -1, len(args), len(kwargs), state)
+                state = push(stack, idx + instr.oploc, pos, 0, -1, len(args), len(kwargs))
                 idx += 1
                 continue
 
             elif instr.opcode == CALL:
-                state = push(idx + 1, -1, 0, -1, -1, -1, state)
-                idx = instr.oploc
-                continue
+                if memo is None or instr.oploc not in self.memoized:
+                    state = push(stack, idx + 1, -1, 0, -1, -1, -1)
+                    idx = instr.oploc
+                    continue
+                entries = memo.get(pos)
+                entry = None if entries is None else entries.get(instr.oploc)
+                if entry is None:
+                    # the rule's frame keeps what RETURN needs to memoize it
+                    state = push(
+                        stack, idx + 1, -1, instr.oploc, pos, len(args), len(kwargs)
+                    )
+                    idx = instr.oploc
+                    continue
+                end, _args, _kwargs = entry
+                if end < 0:
+                    idx = FAILURE
+                else:
+                    pos = end
+                    args.extend(_args)
+                    if _kwargs:
+                        kwargs.extend(_kwargs.items())
 
             elif instr.opcode == COMMIT:
-                state = pop(state)
+                state = pop(stack)
                 idx += instr.oploc
                 continue
 
             elif instr.opcode == UPDATE:
                 if instr.maxcount == -1 or state.count < instr.maxcount:
+                    state.count += 1
                     state.pos = pos
                     state.argidx = len(args)
                     state.kwidx = len(kwargs)
                     idx += instr.oploc
                 else:
-                    state = pop(state)
+                    state = pop(stack)
                     idx += 1
                 continue
 
             elif instr.opcode == RESTORE:
                 pos = state.pos
-                state = pop(state)
+                state = pop(stack)
                 idx += instr.oploc
                 continue
 
             elif instr.opcode == FAILTWICE:
                 pos = state.pos
-                state = pop(state)
+                state = pop(stack)
                 idx = FAILURE
 
             elif instr.opcode == RETURN:
                 idx = state.opidx
-                state = pop(state)
+                if state.count:
+                    # most rules bind nothing, so skip slicing when empty
+                    memo.setdefault(state.mark, {})[state.count] = (
+                        pos,
+                        tuple(args[state.argidx:]) if len(args) > state.argidx else (),
+                        (dict(kwargs[state.kwidx:])
+                         if len(kwargs) > state.kwidx else None),
+                    )
+                    if len(memo) > MAX_MEMO_SIZE:
+                        _trim_memo(memo)
+                state = pop(stack)
                 continue
 
             elif instr.opcode == PASS:
@@ -310,18 +387,25 @@ cdef class _Parser:
             if idx == FAILURE:
                 # pos is >= 0 only for backtracking entries
                 while state and state.pos < 0:
-                    state = pop(state)
+                    if state.count:  # a memoized rule failed
+                        memo.setdefault(state.mark, {})[state.count] = (
+                            FAILURE, (), None
+                        )
+                        if len(memo) > MAX_MEMO_SIZE:
+                            _trim_memo(memo)
+                    state = pop(stack)
                 idx = state.opidx
                 pos = state.pos
-                args[state.argidx:] = []
+                del args[state.argidx:]
                 if kwargs:
-                    kwargs[state.kwidx:] = []
-                state = pop(state)  # pop backtracking entry
+                    del kwargs[state.kwidx:]
+                state = pop(stack)  # pop backtracking entry
             else:
                 if instr.capturing:
-                    args[state.argidx:] = [s[state.mark:pos]]
-                    kwargs[state.kwidx:] = []
-                    state = pop(state)
+                    del args[state.argidx:]
+                    args.append(s[state.mark:pos])
+                    del kwargs[state.kwidx:]
+                    state = pop(stack)
 
                 if instr.action is not None:
                     _args, _kwargs = instr.action(
@@ -329,22 +413,27 @@ cdef class _Parser:
                         state.mark,
                         pos,
                         args[state.argidx:],
-                        dict(kwargs[state.kwidx:])
+                        (dict(kwargs[state.kwidx:])
+                         if len(kwargs) > state.kwidx else {})
                     )
                     args[state.argidx:] = _args
                     if not _kwargs:
-                        kwargs[state.kwidx:] = []
+                        del kwargs[state.kwidx:]
                     else:
                         kwargs[state.kwidx:] = _kwargs.items()
-                    state = pop(state)
+                    state = pop(stack)
 
                 idx += 1
 
         if not state:
-            state = push(0, -1, 0, -1, 0, 0, NULL)
-        else:
-            state.pos = pos
-        return state
+            return -1
+        return pos
+
+
+cdef void _trim_memo(dict memo) except *:
+    """Drop the lowest positions from a memo that grew too large."""
+    for pos in sorted(memo)[:DEL_MEMO_SIZE]:
+        del memo[pos]
 
 
 # Program Creation #####################################################
@@ -353,6 +442,9 @@ cdef class _Parser:
 # their effect on the stack
 NO_CAP_OR_ACT = {CALL, COMMIT, UPDATE, RESTORE, FAILTWICE, RETURN}
 
+# These operators jump relative to their own location
+JUMPS = {BRANCH, COMMIT, UPDATE, RESTORE, JUMP}
+
 
 def _make_program(grammar) -> Tuple[_Program, _Index]:
     """A "program" is a set of instructions and mappings."""
@@ -428,12 +520,20 @@ def _loop(defn, mincount, maxcount):
                             marking=pi.marking,
                             capturing=pi.capturing,
                             action=pi.action)]
+    # risk of billion laughs attack
+    head = [pi.copy() for _ in range(mincount) for pi in pis]
+    if maxcount == -1:
+        loopmax = -1
+    elif maxcount > mincount:
+        # UPDATE counts the repetitions after the first in the loop
+        loopmax = maxcount - mincount - 1
+    else:
+        return head or [Instruction(NOOP)]
     return [
-        # risk of billion laughs attack
-        *(pi.copy() for _ in range(mincount) for pi in pis),
+        *head,
         Instruction(BRANCH, len(pis) + 2),
         *pis,
-        Instruction(UPDATE, -len(pis), maxcount=maxcount)
+        Instruction(UPDATE, -len(pis), maxcount=loopmax)
     ]
 
 
@@ -457,8 +557,8 @@ def _not(defn):
 
 
 def _cap(defn):
-    captured_choice = defn.args[0].op == Operator.CHC
     pis = _parsing_instructions(defn.args[0])
+    skipped = _jumps_past(pis)
     if not pis[0].marking:
         pis[0].marking = True
     else:
@@ -467,7 +567,7 @@ def _cap(defn):
     if (not pi.capturing
         and pi.action is None
         and pi.opcode not in NO_CAP_OR_ACT
-        and not captured_choice
+        and not skipped
     ):
         pis[-1].capturing = True
     else:
@@ -480,11 +580,36 @@ def _bnd(defn):
 
 
 def _seq(defn):
-    head = [pi
-            for d in defn.args[0][:-1]
-            for pi in _parsing_instructions(d)]
-    tail = _parsing_instructions(defn.args[0][-1])
-    return head + tail
+    pis = []
+    fusable = False
+    for d in defn.args[0]:
+        _pis = _parsing_instructions(d)
+        # Runs of plain scans are fused into a single scan; only
+        # single-instruction terms are considered so no jump can land
+        # inside the run.
+        if len(_pis) == 1 and _plain_scan(_pis[0]):
+            if fusable:
+                pis[-1] = Instruction(
+                    SCAN, scanner=_fuse(pis[-1].scanner, _pis[0].scanner)
+                )
+                continue
+            fusable = True
+        else:
+            fusable = False
+        pis.extend(_pis)
+    return pis
+
+
+cdef bint _plain_scan(Instruction pi):
+    return (pi.opcode == SCAN
+            and not (pi.marking or pi.capturing)
+            and pi.action is None)
+
+
+cdef Scanner _fuse(Scanner a, Scanner b):
+    if isinstance(a, Sequence):
+        return Sequence([*(<Sequence>a)._scanners, b])
+    return Sequence([a, b])
 
 
 def _chc(defn):
@@ -498,18 +623,27 @@ def _chc(defn):
     return pi
 
 
+def _jumps_past(pis) -> bool:
+    # if anything jumps to just past the last instruction, as choices and
+    # lookaheads do, the last one does not run on every successful match
+    n = len(pis)
+    return any(pi.opcode in JUMPS and i + pi.oploc == n
+               for i, pi in enumerate(pis))
+
+
 def _rul(defn):
     subdefn, action, _ = defn.args
     pis = _parsing_instructions(subdefn)
     if action is None:
         return pis
+    skipped = _jumps_past(pis)
     pi = pis[0]
     if not pi.marking:
         pi.marking = True
     else:
         pis.insert(0, Instruction(NOOP, marking=True))
     pi = pis[-1]
-    if pi.action is None and pi.opcode not in NO_CAP_OR_ACT:
+    if pi.action is None and pi.opcode not in NO_CAP_OR_ACT and not skipped:
         pi.action = action
     else:
         pis.append(Instruction(NOOP, action=action))
@@ -555,21 +689,30 @@ cdef class Dot(Scanner):
 cdef class Literal(Scanner):
     cdef str _x
     cdef int _xlen
+    cdef Py_UCS4 _c
 
     def __init__(self, str x):
         self._x = x
         self._xlen = len(x)
+        if self._xlen == 1:
+            self._c = x[0]
 
     cdef int _scan(self, str s, int pos, int slen) except -2:
-        cdef int end = pos + self._xlen
-        if s[pos:end] != self._x:
+        if self._xlen == 1:
+            # most literals are one character, compared as a code point
+            if pos < slen and s[pos] == self._c:
+                return pos + 1
+            return FAILURE
+        # startswith() compares in place instead of slicing a copy
+        if not s.startswith(self._x, pos):
             return FAILURE
-        return end
+        return pos + self._xlen
 
 
 cdef class CharacterClass(Scanner):
     cdef:
         str _chars, _ranges
+        bytes _table
         int _rangelen
         bint _negate
     cdef public:
@@ -585,12 +728,14 @@ cdef class CharacterClass(Scanner):
         self._chars = ''.join(a for a, b in ranges if not b)
         self._ranges = ''.join(a+b for a, b in ranges if b)
         self._rangelen = len(self._ranges)
+        self._table = _class_table(ranges)
         self._negate = negate
         self.mincount = mincount
         self.maxcount = maxcount
 
     cdef int _scan(self, str s, int pos, int slen) except -2:
         cdef Py_UCS4 c
+        cdef const unsigned char* table = self._table
         cdef str ranges = self._ranges
         cdef bint matched
         cdef int mincount = self.mincount
@@ -599,7 +744,9 @@ cdef class CharacterClass(Scanner):
         while maxcount and pos < slen:
             c = s[pos]
             matched = False
-            if c in self._chars:
+            if c < 256:
+                matched = table[c]
+            elif c in self._chars:
                 matched = True
             else:
                 while i < self._rangelen:
@@ -619,14 +766,40 @@ cdef class CharacterClass(Scanner):
         return pos
 
 
+cdef bytes _class_table(list ranges):
+    """Return a lookup table of the first 256 characters in *ranges*."""
+    cdef bytearray table = bytearray(256)
+    for a, b in ranges:
+        for o in range(ord(a), min(ord(b or a), 255) + 1):
+            table[o] = 1
+    return bytes(table)
+
+
+cdef class Sequence(Scanner):
+    cdef list _scanners
+
+    def __init__(self, list scanners):
+        self._scanners = scanners
+
+    cdef int _scan(self, str s, int pos, int slen) except -2:
+        cdef Scanner scanner
+        for scanner in self._scanners:
+            pos = scanner._scan(s, pos, slen)
+            if pos < 0:
+                return FAILURE
+        return pos
+
+
 cdef class Regex(Scanner):
     cdef object _regex
+    cdef object _match
 
     def __init__(self, str pattern, int flags=0):
-        self._regex = re.compile(pattern, flags=flags)
+        self._regex = compile_regex(pattern, flags=flags)
+        self._match = self._regex.match
 
     cdef int _scan(self, str s, int pos, int slen) except -2:
-        m = self._regex.match(s, pos=pos)
+        m = self._match(s, pos)
         if m is None:
             return FAILURE
         else:
@@ -662,14 +835,13 @@ cdef class Regex(Scanner):
 #               'name' if pi.name else '')
 
 
-# cdef _print_stack(State* state):
-#     states = []
-#     while state:
-#         states.append(
+# cdef _print_stack(Stack* stack):
+#     cdef State* state
+#     print(f'stack ({stack.top + 1} entries):')
+#     for i in range(stack.top + 1):
+#         state = &stack.states[i]
+#         print(
+#             ' '*i,
 #             f'<State (opidx={state.opidx}, pos={state.pos}, count={state.count},'
 #             f' mark={state.mark}, argidx={state.argidx}, kwidx={state.kwidx})>'
 #         )
-#         state = state.prev
-#     print(f'stack ({len(states)} entries):')
-#     for i, s in enumerate(reversed(states)):
-#         print(' '*i, s)
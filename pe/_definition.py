@@ -151,8 +151,8 @@ _format_map: Dict[Operator, _Formatter] = {
 
 def _format(defn: Definition,
             prev_op: Operator) -> str:
-    op = defn.op
-    if op in _format_map:
-        return _format_map[op](defn, prev_op)
-    else:
-        raise Error(f'invalid operation: {defn.op!r}')
+    try:
+        func = _format_map[defn.op]
+    except KeyError:
+        raise Error(f'invalid operation: {defn.op!r}') from None
+    return func(defn, prev_op)
@@ -57,4 +57,6 @@ def _unescape(m: reMatch):
 
 def unescape(string: str):
     """Unescape special characters for literals and character classes."""
+    if '\\' not in string:  # most literals have no escapes
+        return string
     return _unescape_re.sub(_unescape, string)
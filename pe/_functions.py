@@ -1,5 +1,6 @@
 
 from typing import Union, Dict, Callable, Optional
+from functools import lru_cache
 
 from pe.actions import Action
 from pe._constants import Flag
@@ -7,7 +8,7 @@ from pe._definition import Definition
 from pe._errors import Error
 from pe._parser import Parser
 from pe._grammar import Grammar
-from pe._parse import loads
+from pe._parse import loads, _cacheable
 from pe.patterns import DEFAULT_IGNORE
 
 _FuncMap = Dict[str, Union[Action, Callable]]
@@ -64,9 +65,21 @@ def match(pattern: str,
         >>> pe.match(r'"-"? [1-9] [0-9]*', '-12345').group()
         '-12345'
     """
-    expr = compile(pattern,
-                   actions=actions,
-                   parser=parser,
-                   ignore=ignore,
-                   flags=Flag.OPTIMIZE)
+    if actions is None and ignore is DEFAULT_IGNORE and _cacheable(pattern):
+        expr = _compile_pattern(pattern, parser)
+    else:
+        expr = compile(pattern,
+                       actions=actions,
+                       parser=parser,
+                       ignore=ignore,
+                       flags=Flag.OPTIMIZE)
     return expr.match(string, flags=flags)
+
+
+# as with re.match(), the same pattern is often matched many times, so
+# the most recent parsers compiled without actions or a custom ignore
+# pattern are kept; building a parser costs far more than loading its
+# grammar
+@lru_cache(maxsize=32)
+def _compile_pattern(pattern: str, parser: str) -> Parser:
+    return compile(pattern, parser=parser, flags=Flag.OPTIMIZE)
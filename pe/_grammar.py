@@ -9,6 +9,9 @@ from pe.operators import Rule, Nonterminal
 
 _FuncMap = Dict[str, Union[Action, Callable]]
 
+_TERMINALS = (Operator.DOT, Operator.LIT, Operator.CLS, Operator.RGX)
+_NESTED = (Operator.SEQ, Operator.CHC)
+
 
 class Grammar:
     """A parsing expression grammar definition."""
@@ -45,14 +48,20 @@ class Grammar:
             return self.definitions[name]
 
     def __eq__(self, other: object):
+        if self is other:
+            return True
         if not isinstance(other, Grammar):
             return NotImplemented
+        # compare the cheap parts first to avoid walking definitions
         return (self.start == other.start
-                and self.definitions == other.definitions
-                and self.actions == other.actions)
+                and self.definitions.keys() == other.definitions.keys()
+                and self.actions == other.actions
+                and self.definitions == other.definitions)
 
     def _finalize(self):
-        defs = _insert_rules(self.definitions, self.actions)
+        defs = self.definitions
+        if self.actions:
+            defs = _insert_rules(defs, self.actions)
         # now recursively finalize expressions
         for expr in defs.values():
             _finalize(expr, defs, True)
@@ -77,9 +86,9 @@ def _finalize(expr, defs, structured):
         name = args[0]
         if name not in defs:
             raise Error(f'undefined nonterminal: {args[0]}')
-    elif op in (Operator.DOT, Operator.LIT, Operator.CLS, Operator.RGX):
+    elif op in _TERMINALS:
         pass
-    elif op in (Operator.SEQ, Operator.CHC):
+    elif op in _NESTED:
         for term in args[0]:
             _finalize(term, defs, structured)
     elif op == Operator.CAP:
@@ -1,6 +1,5 @@
 
-from typing import Union, Tuple, List, Dict, Any
-import textwrap
+from typing import Union, Tuple, Dict, Optional, Any
 
 from pe._definition import Definition
 
@@ -8,58 +7,63 @@ from pe._definition import Definition
 class Match:
     """The result of a parsing expression match."""
 
-    __slots__ = 'string', '_pos', '_end', 'pe', '_args', '_kwargs'
+    __slots__ = 'string', 'pos', '_end', 'pe', '_args', '_kwargs'
 
     def __init__(self,
                  string: str,
                  pos: int,
                  end: int,
                  pe: Definition,
-                 args: List,
-                 kwargs: Dict):
+                 args: Optional[Tuple] = None,
+                 kwargs: Optional[Dict] = None):
         self.string = string
-        self._pos = pos
+        self.pos = pos
         self._end = end
         self.pe = pe
-        self._args = args
-        self._kwargs = kwargs
+        # empty groups are stored as None to avoid allocating per match
+        self._args = args or None
+        self._kwargs = kwargs or None
 
     def __repr__(self):
-        pos, end = self._pos, self._end
-        string = self.string[pos:end]
-        substr = textwrap.shorten(string, width=20, placeholder='...')
+        pos, end = self.pos, self._end
+        substr = self.string[pos:end]
+        if len(substr) > 20:
+            import textwrap
+            substr = textwrap.shorten(substr, width=20, placeholder='...')
         return (f'<{type(self).__name__} object;'
                 f' span=({pos}, {end}), match={substr!r}>')
 
     def start(self) -> int:
-        return self._pos
+        return self.pos
 
     def end(self) -> int:
         return self._end
 
     def span(self) -> Tuple[int, int]:
-        return (self._pos, self._end)
+        return (self.pos, self._end)
 
     def group(self, key_or_index: Union[str, int] = 0) -> Any:
         if not isinstance(key_or_index, (str, int)):
             raise TypeError(type(key_or_index))
         if key_or_index == 0:
-            return self.string[self._pos:self._end]
+            return self.string[self.pos:self._end]
         elif isinstance(key_or_index, int):
+            args = self._args or ()
             index = key_or_index - 1
-            if index < 0 or index >= len(self._args):
+            if index < 0 or index >= len(args):
                 raise IndexError('no such group')
-            return self._args[index]
+            return args[index]
         else:
-            if key_or_index not in self._kwargs:
+            kwargs = self._kwargs or {}
+            if key_or_index not in kwargs:
                 raise IndexError('no such group')
-            return self._kwargs[key_or_index]
+            return kwargs[key_or_index]
 
-    def groups(self):
-        return tuple(self._args or ())
+    def groups(self) -> Tuple:
+        return self._args or ()
 
-    def groupdict(self):
-        return dict(self._kwargs or ())
+    def groupdict(self) -> Dict:
+        return dict(self._kwargs) if self._kwargs else {}
 
     def value(self):
         return determine(self._args)
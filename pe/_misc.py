@@ -1,5 +1,6 @@
 
 import sys
+from typing import List, Tuple, Union
 
 
 ANSICOLORS = {
@@ -9,9 +10,21 @@ ANSICOLORS = {
 }
 
 
-def ansicolor(color, text, stream=None):
-    if stream is None:
-        stream = sys.stdout
-    if stream.isatty():
+def ansicolor(color, text, stream=None, isatty=None):
+    # callers that color many strings can pass a precomputed *isatty*
+    if isatty is None:
+        if stream is None:
+            stream = sys.stdout
+        isatty = stream.isatty()
+    if isatty:
         text = f'{ANSICOLORS[color.lower()]}{text}\x1b[0m'
     return text
+
+
+def class_table(ranges: List[Tuple[str, Union[str, None]]]) -> bytes:
+    """Return a lookup table of the first 256 characters in *ranges*."""
+    table = bytearray(256)
+    for a, b in ranges:
+        for o in range(ord(a), min(ord(b or a), 255) + 1):
+            table[o] = 1
+    return bytes(table)
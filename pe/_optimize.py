@@ -3,8 +3,14 @@
 Grammar Definition to Regular Expression Conversion
 """
 
+from typing import (
+    Dict, List, Tuple, Set, FrozenSet, Mapping, Iterator, Union, Callable,
+    Pattern,
+)
+import sys
 import re
-from itertools import groupby, count
+from functools import lru_cache
+from itertools import count
 
 from pe._constants import Operator
 from pe._errors import Error
@@ -35,6 +41,7 @@ SYM = Operator.SYM
 OPT = Operator.OPT
 STR = Operator.STR
 PLS = Operator.PLS
+RPT = Operator.RPT
 AND = Operator.AND
 NOT = Operator.NOT
 CAP = Operator.CAP
@@ -43,37 +50,52 @@ SEQ = Operator.SEQ
 CHC = Operator.CHC
 RUL = Operator.RUL
 
+# operator groups for membership tests; Operator hashing goes through
+# Enum.__hash__, so small tuples (compared by identity) beat frozensets
+_NESTED = (SEQ, CHC)  # args[0] is a list of definitions
+_ATOMIC = (DOT, CLS)  # regexes that need no grouping (also 1-char LIT)
+_REGULAR = (DOT, LIT, CLS, RGX)
+
+_Defs = Mapping[str, Definition]
+_GroupIds = Iterator[int]
+_CacheKey = Tuple[str, FrozenSet[str]]
+_Cache = Dict[_CacheKey, Definition]
+_Rewrite = Callable[[Definition], Definition]
+_Range = Tuple[str, Union[str, None]]
+
+# literals and class characters recur across rules, so cache escapes
+_re_escape = lru_cache(maxsize=4096)(re.escape)
+
 
-def optimize(g: Grammar, inline=True, common=True, regex=True):
+def optimize(g: Grammar, inline=True, common=True, regex=True) -> Grammar:
     """Combine adjacent terms into a single regular expression."""
     defs = g.definitions
+    grpid = count(start=1)
 
+    # apply each enabled pass to a definition before moving on to the
+    # next so the grammar is traversed once instead of once per pass;
+    # common rewrites are also applied as inlined nodes are rebuilt
     if inline:
-        new = {}
-        for name, defn in defs.items():
-            new[name] = _inline(defs, defn, {name})
-        defs = new
-
-    if common:
-        new = {}
-        for name, defn in defs.items():
-            new[name] = _common(defn)
-        defs = new
-
-    if regex:
-        new = {}
-        grpid = count(start=1)
-        for name, defn in defs.items():
-            new[name] = _regex(defn, defs, grpid)
-        defs = new
-
-    return Grammar(definitions=defs,
+        refs = _reachable(defs)
+        cache: _Cache = {}
+
+    new = {}
+    for name, defn in defs.items():
+        if inline:
+            defn = _inline(defs, defn, {name}, refs, cache, common)
+        elif common:
+            defn = _common(defn)
+        if regex:
+            defn = _regex(defn, defs, grpid)
+        new[name] = defn
+
+    return Grammar(definitions=new,
                    actions=g.actions,
                    start=g.start)
 
 
 # only need to map mutually recursive operators
-_op_map = {
+_op_map: Dict[Operator, Callable[..., Definition]] = {
     OPT: Optional,
     STR: Star,
     PLS: Plus,
@@ -87,217 +109,554 @@ _op_map = {
 }
 
 
-def _inline(defs, defn, visited):
+# work items for the iterative traversal in _inline()
+_VISIT = 0  # (_VISIT, defn): inline defn
+_BUILD = 1  # (_BUILD, defn): rebuild defn from inlined children
+_LEAVE = 2  # (_LEAVE, defn): cache the expansion of nonterminal defn
+
+
+def _inline(
+    defs: _Defs,
+    defn: Definition,
+    visited: Set[str],
+    refs: Dict[str, Set[str]],
+    cache: _Cache,
+    common=False,
+) -> Definition:
+    # This is a post-order traversal using an explicit stack so that
+    # deeply nested or heavily inlined grammars do not pay for (or
+    # overflow) Python call frames. The *visited* set is shared and
+    # updated as expansions are entered and left. If *common* is true,
+    # each node gets the _common() rewrites as it is rebuilt, which
+    # saves a second traversal that would rebuild the tree again.
+    rewrites: Dict[Operator, _Rewrite] = _common_op_map if common else {}
+    results: List[Definition] = []
+    keys: List[_CacheKey] = []  # cache keys of the expansions entered
+    agenda: List[Tuple[int, Definition]] = [(_VISIT, defn)]
+    push = agenda.append
+    while agenda:
+        action, item = agenda.pop()
+        if action == _BUILD:
+            op = item.op
+            make_op = _op_map[op]
+            if op in _NESTED:
+                # not results[-n:], which is everything when n == 0
+                start = len(results) - len(item.args[0])
+                children = results[start:]
+                del results[start:]
+                built = make_op(*children)
+            else:
+                built = make_op(results.pop(), *item.args[1:])
+            # a 1-item Sequence() or Choice() returns the item itself
+            func = rewrites.get(built.op)
+            results.append(func(built) if func else built)
+            continue
+        elif action == _LEAVE:
+            key = keys.pop()
+            cache[key] = results[-1]
+            visited.remove(key[0])
+            continue
+
+        op = item.op
+        args = item.args
+        # only nonterminals (SYM) can be inlined
+        if op is SYM:
+            name = args[0]
+            if (name in visited                # recursive definition
+                or (defs[name].op is RUL       # rule with action
+                    and defs[name].args[1])):
+                results.append(item)
+                continue
+            # the expansion only depends on the visited names it can reach
+            key = (name, frozenset(visited & refs[name]))
+            if key in cache:
+                results.append(cache[key])
+            else:
+                visited.add(name)
+                keys.append(key)
+                push((_LEAVE, item))
+                push((_VISIT, defs[name]))
+        # for all others, just pass through
+        elif op in _NESTED:
+            push((_BUILD, item))
+            for d in reversed(args[0]):
+                push((_VISIT, d))
+        elif op in _op_map:
+            push((_BUILD, item))
+            push((_VISIT, args[0]))
+        else:
+            func = rewrites.get(op)
+            results.append(func(item) if func else item)
+
+    return results[0]
+
+
+def _reachable(defs: _Defs) -> Dict[str, Set[str]]:
+    """Map each name in *defs* to the names it transitively refers to."""
+    direct = {name: _references(defn) for name, defn in defs.items()}
+    reach: Dict[str, Set[str]] = {}
+    for name in defs:
+        seen: Set[str] = set()
+        agenda = list(direct[name])
+        while agenda:
+            ref = agenda.pop()
+            if ref not in seen:
+                seen.add(ref)
+                agenda.extend(direct.get(ref, ()))
+        reach[name] = seen
+    return reach
+
+
+def _references(defn: Definition) -> Set[str]:
+    """Return the names of nonterminals used directly in *defn*."""
     op = defn.op
-    args = defn.args
+    if op is SYM:
+        return {defn.args[0]}
+    elif op.type == 'Primary':
+        return set()
+    elif op.is_unary():
+        return _references(defn.args[0])
+    else:
+        return set().union(*(_references(d) for d in defn.args[0]))
+
 
-    # only nonterminals (SYM) can be inlined
-    if op == SYM:
+def retried(defs: _Defs) -> Set[str]:
+    """
+    Return the names of the rules in *defs* that may be tried more than
+    once at the same position.
+
+    A rule is retried when it starts more than one alternative of a
+    choice, or when it starts both an optional, repeated, or lookahead
+    item of a sequence and what follows that item. Memoizing other
+    rules only costs time.
+    """
+    names: Set[str] = set()
+    leading: Dict[str, Tuple[Set[str], bool]] = {}
+    agenda = list(defs.values())
+    while agenda:
+        defn = agenda.pop()
+        op = defn.op
+        if op is CHC:
+            alts = [d.args[0] if d.op is SEQ else [d] for d in defn.args[0]]
+            seen: Set[str] = set()
+            for i, items in enumerate(alts):
+                lead = _leading(defn.args[0][i], defs, leading)[0]
+                names.update(seen & lead)
+                seen.update(lead)
+                # alternatives that start with the same items run them
+                # all again, then go on from the same position
+                for other in alts[:i]:
+                    k = 0
+                    while k < min(len(items), len(other)) and items[k] == other[k]:
+                        k += 1
+                    if k:
+                        for item in items[:k]:
+                            names.update(_leading(item, defs, leading)[0])
+                        lead = _leading(Sequence(*items[k:]), defs, leading)[0]
+                        rest = Sequence(*other[k:])
+                        names.update(lead & _leading(rest, defs, leading)[0])
+        elif op is SEQ:
+            items = defn.args[0]
+            for i, d in enumerate(items[:-1]):
+                if d.op in (OPT, STR, PLS, RPT, AND, NOT):
+                    lead = _leading(d.args[0], defs, leading)[0]
+                    if lead:
+                        rest = Sequence(*items[i + 1:])
+                        names.update(lead & _leading(rest, defs, leading)[0])
+        if op in _NESTED:
+            agenda.extend(defn.args[0])
+        elif op.type != 'Primary':
+            agenda.append(defn.args[0])
+    return names
+
+
+def _leading(
+    defn: Definition,
+    defs: _Defs,
+    leading: Dict[str, Tuple[Set[str], bool]],
+) -> Tuple[Set[str], bool]:
+    """
+    Return the names of the rules that *defn* may call at its starting
+    position and whether *defn* may match without consuming input.
+    """
+    op = defn.op
+    args = defn.args
+    names: Set[str] = set()
+    if op is SYM:
         name = args[0]
-        if (name in visited                # recursive definition
-            or (defs[name].op == RUL       # rule with action
-                and defs[name].args[1])):
-            return defn
-        else:
-            return _inline(defs, defs[name], visited | {name})
-    # for all others, just pass through
-    else:
-        make_op = _op_map.get(op)
-        if op in (SEQ, CHC):
-            return make_op(*(_inline(defs, d, visited) for d in args[0]))
-        elif make_op:
-            return make_op(_inline(defs, args[0], visited), *args[1:])
-        else:
-            return defn
+        if name not in leading:
+            # recursive references see only the rule itself
+            leading[name] = ({name}, False)
+            if name in defs:
+                names, nullable = _leading(defs[name], defs, leading)
+                leading[name] = (names | {name}, nullable)
+        return leading[name]
+    elif op is SEQ:
+        for d in args[0]:
+            _names, nullable = _leading(d, defs, leading)
+            names.update(_names)
+            if not nullable:
+                return names, False
+        return names, True
+    elif op is CHC:
+        nullable = False
+        for d in args[0]:
+            _names, _nullable = _leading(d, defs, leading)
+            names.update(_names)
+            nullable = nullable or _nullable
+        return names, nullable
+    elif op in (OPT, STR, AND, NOT):
+        return _leading(args[0], defs, leading)[0], True
+    elif op is RPT:
+        names, nullable = _leading(args[0], defs, leading)
+        return names, nullable or args[1] == 0
+    elif op in (PLS, CAP, BND, RUL):
+        return _leading(args[0], defs, leading)
+    elif op is LIT:
+        return names, not args[0]
+    elif op in (DOT, CLS):
+        return names, False
+    elif op is RGX:
+        # lookarounds may make a nullable pattern fail on the empty
+        # string; that only loses memoization, never correctness
+        pattern = args[0]
+        if isinstance(pattern, str):
+            pattern = compile_regex(pattern, flags=args[1])
+        return names, pattern.match('') is not None
+    return names, True
+
+
+def _without_values(defn: Definition) -> Definition:
+    """
+    Return *defn* without the captures and bindings in it.
+
+    Nonterminals and rules are kept as they are, as their actions may
+    do more than compute values.
+    """
+    op = defn.op
+    if op is CAP or op is BND:
+        return _without_values(defn.args[0])
+    elif op in _NESTED:
+        subdefs = defn.args[0]
+        newdefs = [_without_values(d) for d in subdefs]
+        if any(new is not old for new, old in zip(newdefs, subdefs)):
+            return _op_map[op](*newdefs)
+    elif op in _op_map and op is not RUL:
+        subdef = _without_values(defn.args[0])
+        if subdef is not defn.args[0]:
+            return _op_map[op](subdef, *defn.args[1:])
+    return defn
 
 
-def _common(defn):
+def _common(defn: Definition) -> Definition:
     op = defn.op
 
-    # descend first
+    # descend first, only rebuilding when a subexpression changed
     make_op = _op_map.get(op)
-    if op in (SEQ, CHC):
-        defn = make_op(*(_common(d) for d in defn.args[0]))
+    if op in _NESTED:
+        subdefs = defn.args[0]
+        newdefs = [_common(d) for d in subdefs]
+        if any(new is not old for new, old in zip(newdefs, subdefs)):
+            defn = _op_map[op](*newdefs)
     elif make_op:
-        defn = make_op(_common(defn.args[0]), *defn.args[1:])
+        subdef = _common(defn.args[0])
+        if subdef is not defn.args[0]:
+            defn = make_op(subdef, *defn.args[1:])
 
-    # [.]  ->  "."  (only 1-char class, not a range, not negated)
-    if op == CLS:
-        ranges = defn.args[0]
-        negated = defn.args[1]
-        if len(ranges) == 1 and ranges[0][1] is None and not negated:
-            defn = Literal(ranges[0][0])
+    func = _common_op_map.get(defn.op)
+    if func:
+        defn = func(defn)
 
-    elif op == SEQ:
-        defn = _common_sequence(defn)
+    return defn
 
-    elif op == CHC:
-        defn = _common_choice(defn)
 
+def _common_class(defn: Definition) -> Definition:
+    # [.]  ->  "."  (only 1-char class, not a range, not negated)
+    ranges = defn.args[0]
+    negated = defn.args[1]
+    if len(ranges) == 1 and ranges[0][1] is None and not negated:
+        defn = Literal(ranges[0][0])
     return defn
 
 
-def _common_sequence(defn):
+def _common_sequence(defn: Definition) -> Definition:
+    subdefs = defn.args[0]
+    n = len(subdefs)
+    out = []
     i = 0
-    subdefs = list(defn.args[0])
-    while i < len(subdefs) - 1:
+    while i < n:
         d = subdefs[i]
         # ![...] .  ->  [^...]
         # !"." .    ->  [^.]
-        if (d.op == NOT and subdefs[i+1].op == DOT):
+        if d.op is NOT and i + 1 < n and subdefs[i+1].op is DOT:
             notd = d.args[0]
-            if notd.op == CLS:
-                negated = not notd.args[1]
-                subdefs[i:i+2] = [Class(notd.args[0], negate=negated)]
-            elif notd.op == LIT and len(notd.args[0]) == 1:
-                subdefs[i:i+2] = [Class(notd.args[0], negate=True)]
+            if notd.op is CLS:
+                ranges, negated = notd.args
+                # ranges may be given as lists, which cannot be cache keys
+                out.append(_inverted_class(tuple(map(tuple, ranges)),
+                                           not negated))
+                i += 2
+                continue
+            elif notd.op is LIT and len(notd.args[0]) == 1:
+                out.append(_inverted_class(((notd.args[0], None),), True))
+                i += 2
+                continue
+        # [.]* [.]*  ->  [.]*
+        # [.]+ [.]?  ->  [.]+
+        elif d.op in (STR, PLS) and d.args[0].op in _REGULAR:
+            j = i + 1
+            while (j < n
+                   and subdefs[j].op in (STR, OPT)
+                   and subdefs[j].args[0] == d.args[0]):
+                j += 1
+            if j - i > 1:
+                out.append(d)
+                i = j
+                continue
         # "." "."  -> ".."
-        elif d.op == LIT:
+        elif d.op is LIT:
             j = i + 1
-            while j < len(subdefs) and subdefs[j].op == LIT:
+            while j < n and subdefs[j].op is LIT:
                 j += 1
             if j - i > 1:
-                subdefs[i:j] = [Literal(''.join(x.args[0] for x in subdefs[i:j]))]
+                out.append(Literal(''.join([x.args[0] for x in subdefs[i:j]])))
+                i = j
+                continue
+        out.append(d)
         i += 1
-    return Sequence(*subdefs)
+    return Sequence(*out)
 
 
-def _common_choice(defn):
+@lru_cache(maxsize=1024)
+def _inverted_class(ranges: Tuple[_Range, ...], negated) -> Definition:
+    return Class(list(ranges), negate=negated)
+
+
+def _common_choice(defn: Definition) -> Definition:
+    subdefs = defn.args[0]
+    n = len(subdefs)
+    out = []
     i = 0
-    subdefs = list(defn.args[0])
-    while i < len(subdefs) - 1:
+    while i < n:
         d = subdefs[i]
         # [..] / [..]  ->  [....]
         # [..] / "."   ->  [...]
-        if (d.op == CLS and not d.args[1]) or (d.op == LIT and len(d.args[0]) == 1):
-            ranges = list(d.args[0]) if d.op == CLS else [(d.args[0], None)]
+        if (d.op is CLS and not d.args[1]) or (d.op is LIT and len(d.args[0]) == 1):
+            ranges = list(d.args[0]) if d.op is CLS else [(d.args[0], None)]
             j = i + 1
-            while j < len(subdefs):
+            while j < n:
                 d2 = subdefs[j]
-                if d2.op == CLS and not d2.args[1]:
+                if d2.op is CLS and not d2.args[1]:
                     ranges.extend(d2.args[0])
-                elif d2.op == LIT and len(d2.args[0]) == 1:
+                elif d2.op is LIT and len(d2.args[0]) == 1:
                     ranges.append((d2.args[0], None))
                 else:
                     break
                 j += 1
             if j - i > 1:
-                subdefs[i:j] = [Class(sorted(set(ranges), key=_range_sort_key))]
+                out.append(Class(sorted(set(ranges), key=_range_sort_key)))
+                i = j
+                continue
+        out.append(d)
         i += 1
-    return Choice(*subdefs)
+    return Choice(*out)
+
+
+_common_op_map: Dict[Operator, _Rewrite] = {
+    CLS: _common_class,
+    SEQ: _common_sequence,
+    CHC: _common_choice,
+}
 
 
-def _range_sort_key(range):
+def _range_sort_key(range: _Range) -> Tuple[bool, _Range]:
     """Ensure single hyphen characters are the first."""
     return (range != ("-", None), range)
 
 
-def _regex_dot(defn, defs, grpid):
-    return Regex('(?s:.)')
+# definitions are not mutated, so constant results can be shared
+_DOT_REGEX = Regex('(?s:.)')
+
+
+def _regex_dot(defn: Definition, defs: _Defs, grpid: _GroupIds) -> Definition:
+    return _DOT_REGEX
 
 
-def _regex_literal(defn, defs, grpid):
-    return Regex(re.escape(defn.args[0]))
+def _regex_literal(defn: Definition, defs: _Defs, grpid: _GroupIds) -> Definition:
+    return _literal_regex(defn.args[0])
 
 
-def _regex_class(defn, defs, grpid):
-    neg = '^' if defn.args[1] else ''
-    clsstr = ''.join(
-        f'{re.escape(a)}-{re.escape(b)}' if b else re.escape(a)
-        for a, b in defn.args[0]
-    )
-    return Regex(f'[{neg}{clsstr}]')
+# regex terminals are never modified after construction, so equal
+# ones can share a single Definition object
+@lru_cache(maxsize=4096)
+def _literal_regex(string: str) -> Definition:
+    return Regex(_re_escape(string))
 
 
-def _regex_sequence(defn, defs, grpid):
-    _subdefs = [_regex(subdef, defs, grpid) for subdef in defn.args[0]]
+def _regex_class(defn: Definition, defs: _Defs, grpid: _GroupIds) -> Definition:
+    ranges, negated = defn.args
+    # ranges may be given as lists, which cannot be cache keys
+    return _class_regex(tuple(map(tuple, ranges)), negated)
+
+
+@lru_cache(maxsize=1024)
+def _class_regex(ranges: Tuple[_Range, ...], negated) -> Definition:
+    parts = ['[^' if negated else '[']
+    for a, b in ranges:
+        parts.append(_re_escape(a))
+        if b:
+            parts.append('-')
+            parts.append(_re_escape(b))
+    parts.append(']')
+    return Regex(''.join(parts))
+
+
+def _regex_sequence(defn: Definition, defs: _Defs, grpid: _GroupIds) -> Definition:
     subdefs = []
-    for k, grp in groupby(_subdefs, key=lambda d: d.op):
+    pending = []  # adjacent regex patterns waiting to be joined
+    for subdef in defn.args[0]:
+        d = _regex(subdef, defs, grpid)
         # only join regexes in sequence if unstructured
-        if k == RGX:
-            subdefs.append(Regex(''.join(d.args[0] for d in grp)))
+        if d.op is RGX:
+            pending.append(d)
         else:
-            subdefs.extend(grp)
-
+            if pending:
+                subdefs.append(_join_sequence(pending))
+                pending.clear()
+            subdefs.append(d)
+    if pending:
+        subdefs.append(_join_sequence(pending))
+
+    if len(subdefs) == 1:  # no need to validate and unwrap it again
+        return subdefs[0]
     return Sequence(*subdefs)
 
 
-def _regex_choice(defn, defs, grpid):
+def _join_sequence(regexes: List[Definition]) -> Definition:
+    if len(regexes) == 1:
+        return regexes[0]
+    return Regex(''.join([d.args[0] for d in regexes]))
+
+
+def _regex_choice(defn: Definition, defs: _Defs, grpid: _GroupIds) -> Definition:
     items = [_regex(d, defs, grpid) for d in defn.args[0]]
     subdefs = []
-    for k, grp in groupby(items, key=lambda d: d.op):
-        grp = list(grp)
-        if k == RGX and len(grp) > 1:
-            gid = f'_{next(grpid)}'
-            subdefs.append(
-                Regex(f'(?=(?P<{gid}>'
-                      + '|'.join(sd.args[0] for sd in grp)
-                      + f'))(?P={gid})'))
+    pending = []  # adjacent regex alternatives waiting to be joined
+    for d in items:
+        if d.op is RGX:
+            pending.append(d)
         else:
-            subdefs.extend(grp)
+            if pending:
+                subdefs.append(_join_choice(pending, grpid))
+                pending.clear()
+            subdefs.append(d)
+    if pending:
+        subdefs.append(_join_choice(pending, grpid))
+    if len(subdefs) == 1:
+        return subdefs[0]
     return Choice(*subdefs)
 
 
-def _regex_optional(defn, defs, grpid):
+def _join_choice(regexes: List[Definition], grpid: _GroupIds) -> Definition:
+    if len(regexes) == 1:
+        return regexes[0]
+    return Regex(_atomic('|'.join([d.args[0] for d in regexes]), grpid))
+
+
+def _atomic(pattern: str, grpid: _GroupIds) -> str:
+    # emulate an atomic group with a lookahead and a backreference
+    n = next(grpid)
+    return '(?=(?P<_%d>%s))(?P=_%d)' % (n, pattern, n)
+
+
+# Python 3.11 added atomic groups to the re module
+_NATIVE_ATOMIC = sys.version_info >= (3, 11)
+_ATOMIC_END = re.compile(r'\)\)\(\?P=_(\d+)\)')
+
+
+def compile_regex(pattern: str, flags: int = 0) -> Pattern:
+    """
+    Compile *pattern* with native atomic groups if they are available.
+
+    The patterns built by :func:`regex` emulate atomic groups with a
+    lookahead and a backreference, which captures the group and then
+    compares the match against itself. Native atomic groups match the
+    same strings in about half the time.
+    """
+    if _NATIVE_ATOMIC:
+        for n in _ATOMIC_END.findall(pattern):
+            start = f'(?=(?P<_{n}>'
+            if start in pattern:
+                pattern = (pattern.replace(start, '(?>')
+                                  .replace(f'))(?P=_{n})', ')'))
+    return re.compile(pattern, flags=flags)
+
+
+def _quantifiable(subdef: Definition, pattern: str) -> str:
+    # a quantifier applies to the whole pattern only if it is one unit
+    if subdef.op in _ATOMIC or (subdef.op is LIT and len(subdef.args[0]) == 1):
+        return pattern
+    return f'(?:{pattern})'
+
+
+def _regex_optional(defn: Definition, defs: _Defs, grpid: _GroupIds) -> Definition:
     subdef = defn.args[0]
     d = _regex(defn.args[0], defs, grpid)
-    if d.op == RGX:
-        subpat = d.args[0] if subdef.op in (DOT, LIT, CLS) else f'(?:{d.args[0]})'
+    if d.op is RGX:
+        subpat = _quantifiable(subdef, d.args[0])
         return Regex(f'{subpat}?')
     else:
         return Optional(d)
 
 
-def _regex_star(defn, defs, grpid):
+def _regex_star(defn: Definition, defs: _Defs, grpid: _GroupIds) -> Definition:
     subdef = defn.args[0]
     d = _regex(subdef, defs, grpid)
-    if d.op == RGX:
-        subpat = d.args[0] if subdef.op in (DOT, LIT, CLS) else f'(?:{d.args[0]})'
-        gid = f'_{next(grpid)}'
-        return Regex(f'(?=(?P<{gid}>{subpat}*))(?P={gid})')
+    if d.op is RGX:
+        subpat = _quantifiable(subdef, d.args[0])
+        return Regex(_atomic(subpat + '*', grpid))
     else:
         return Star(d)
 
 
-def _regex_plus(defn, defs, grpid):
+def _regex_plus(defn: Definition, defs: _Defs, grpid: _GroupIds) -> Definition:
     subdef = defn.args[0]
     d = _regex(defn.args[0], defs, grpid)
-    if d.op == RGX:
-        subpat = d.args[0] if subdef.op in (DOT, LIT, CLS) else f'(?:{d.args[0]})'
-        gid = f'_{next(grpid)}'
-        return Regex(f'(?=(?P<{gid}>{subpat}+))(?P={gid})')
+    if d.op is RGX:
+        subpat = _quantifiable(subdef, d.args[0])
+        return Regex(_atomic(subpat + '+', grpid))
     else:
         return Plus(d)
 
 
-def _regex_and(defn, defs, grpid):
+def _regex_and(defn: Definition, defs: _Defs, grpid: _GroupIds) -> Definition:
     d = _regex(defn.args[0], defs, grpid)
-    if d.op == RGX:
+    if d.op is RGX:
         return Regex(f'(?={d.args[0]})')
     else:
         return And(d)
 
 
-def _regex_not(defn, defs, grpid):
+def _regex_not(defn: Definition, defs: _Defs, grpid: _GroupIds) -> Definition:
     d = _regex(defn.args[0], defs, grpid)
-    if d.op == RGX:
+    if d.op is RGX:
         return Regex(f'(?!{d.args[0]})')
     else:
         return Not(d)
 
 
-def _regex_capture(defn, defs, grpid):
+def _regex_capture(defn: Definition, defs: _Defs, grpid: _GroupIds) -> Definition:
     subdef = _regex(defn.args[0], defs, grpid)
     return Capture(subdef)
 
 
-def _regex_bind(defn, defs, grpid):
+def _regex_bind(defn: Definition, defs: _Defs, grpid: _GroupIds) -> Definition:
     d, name = defn.args
     subdef = _regex(d, defs, grpid)
     return Bind(subdef, name=name)
 
 
-def _regex_rule(defn, defs, grpid):
+def _regex_rule(defn: Definition, defs: _Defs, grpid: _GroupIds) -> Definition:
     subdef, action, name = defn.args
     newdefn = _regex(subdef, defs, grpid)
     if action is not None:
@@ -322,7 +681,7 @@ _regex_op_map = {
 }
 
 
-def _regex(defn: Definition, defs, grpid):
+def _regex(defn: Definition, defs: _Defs, grpid: _GroupIds) -> Definition:
     """
     Convert patterns to regular expressions if they do not emit or
     bind values.
@@ -332,7 +691,12 @@ def _regex(defn: Definition, defs, grpid):
     """
     # TODO: when merging regexes with flags, use local flags,
     #       (?imsx:-imsx:...)
-    func = _regex_op_map.get(defn.op)
+    op = defn.op
+    if op is RGX:  # already converted
+        return defn
+    elif op is DOT:
+        return _DOT_REGEX
+    func = _regex_op_map.get(op)
     if func:
         rgx = func(defn, defs, grpid)
         return rgx
@@ -340,10 +704,10 @@ def _regex(defn: Definition, defs, grpid):
         return defn
 
 
-def regex(defn: Definition):
+def regex(defn: Definition) -> Definition:
     # this can be expanded if there are no nonterminals, captures, or actions
-    if defn.op not in (DOT, LIT, CLS, RGX):
+    if defn.op not in _REGULAR:
         raise Error(f'cannot convert {defn.op} to a regular expression')
-    elif defn.op != RGX:
+    elif defn.op is not RGX:
         defn = _regex(defn, {}, count(start=1))
     return defn
@@ -80,10 +80,11 @@ The syntax is defined as follows::
   EndOfFile  <- !.
 """
 
-from functools import partial
-from typing import Tuple, Dict, cast
+from functools import partial, lru_cache
+from typing import Union, Tuple, Dict, cast
 
 import pe
+from pe._constants import Flag
 from pe._errors import Error, ParseError, GrammarError
 from pe._definition import Definition
 from pe._grammar import Grammar
@@ -102,6 +103,7 @@ from pe.operators import (
     Bind,
     Sequence,
     Choice,
+    Regex,
     AutoIgnore,
     SymbolTable,
 )
@@ -109,30 +111,34 @@ from pe.packrat import PackratParser
 from pe.actions import Constant, Pack, Warn
 
 
+# Terminals recur within and across grammars and are never modified
+# after they are built, so identical ones share a definition.
+
+_DOT = Dot()
+
+
+@lru_cache(maxsize=1024)
 def _make_literal(s):
     return Literal(pe.unescape(s[1:-1]))
 
 
+@lru_cache(maxsize=1024)
 def _make_class(s):
     return Class(pe.unescape(s))
 
 
-def _make_quantified(primary, quantifier=None):
-    if not quantifier:
-        return primary
-    else:
-        return quantifier(primary)
+# Quantified has no action, so its quantifier binding reaches Valued
+# and both are applied with one call
 
-
-def _make_binder(x):
-    return lambda p, x=x: Bind(p, name=x)
-
-
-def _make_valued(quantified, prefix=None):
+def _make_valued(primary, prefix=None, quantifier=None):
+    if quantifier:
+        primary = quantifier(primary)
     if not prefix:
-        return quantified
+        return primary
+    elif isinstance(prefix, str):  # a binding's name
+        return Bind(primary, name=prefix)
     else:
-        return prefix(quantified)
+        return prefix(primary)
 
 
 def _make_sequential(exprs):
@@ -159,6 +165,16 @@ def _make_definition(identifier, expr, defop=None):
     return (identifier, expr)
 
 
+# The bodies of literals, (!['] Char)* or (!["] Char)*, and of classes,
+# (!']' Range)*, are consulted for every character they contain, so
+# they are matched with single regular expressions; this is the escaped
+# part of Char
+_ESCAPE = (r'\\(?:[tnvfr"\'\[\]\\]|[0-7]{1,3}|x[0-9a-fA-F]{2}'
+           r'|u[0-9a-fA-F]{4}|U[0-9a-fA-F]{8})')
+_CHAR = r'(?:[^\\]|%s)' % _ESCAPE
+# the regex stops before a range ending in "]" so that Range can warn
+_RANGES = r'(?:(?!\])%s(?!-\])(?:-%s)?)*' % (_CHAR, _CHAR)
+
 V = SymbolTable()
 
 # Hierarchical syntax
@@ -186,16 +202,19 @@ V.RepeatSpec = Choice(
     Bind(V.Integer, name="count")
 )
 V.Primary = Choice(V.Name, V.Group, V.Literal, V.Class, V.DOT)
-V.Name = Sequence(V.Identifier, V.Spacing, Not(V.Operator))
+V.Name = Sequence(V.Identifier, Not(V.Operator))
 V.Group = Sequence(V.OPEN, V.Expression, V.CLOSE)
 V.Literal = Sequence(
     Choice(
-        Capture(Sequence("'", Star(Sequence(Not("'"), V.Char)), "'")),
-        Capture(Sequence('"', Star(Sequence(Not('"'), V.Char)), '"'))),
+        Capture(Sequence("'", Regex(r"(?:[^'\\]|%s)*" % _ESCAPE), "'")),
+        Capture(Sequence('"', Regex(r'(?:[^"\\]|%s)*' % _ESCAPE), '"'))),
     V.Spacing
 )
 V.Class = Sequence(
-    '[', Capture(Star(Sequence(Not(']'), V.Range))), ']', V.Spacing
+    '[',
+    Capture(Sequence(Regex(_RANGES), Star(Sequence(Not(']'), V.Range)))),
+    ']',
+    V.Spacing
 )
 
 # Non-recursive patterns
@@ -210,16 +229,15 @@ V.UTF16 = Sequence('u', *([V.Hex] * 4))
 V.UTF32 = Sequence('U', *([V.Hex] * 8))
 V.Char = Choice(
     Sequence('\\', Choice(V.Special, V.Octal, V.UTF8, V.UTF16, V.UTF32)),
-    Sequence(Not('\\'), Dot())
+    Sequence(Not('\\'), _DOT)
 )
 V.RangeEndWarn = Literal(']')
 V.Range = Choice(Sequence(V.Char, '-', Choice(V.RangeEndWarn, V.Char)), V.Char)
 V.IdentStart = Class('a-zA-Z_')
 V.IdentCont = Class('a-zA-Z_0-9')
-V.Identifier = Sequence(
-    Capture(Sequence(V.IdentStart, Star(V.IdentCont))), V.Spacing
-)
-V.Integer = Sequence(Capture(Plus(Class('0-9'))), V.Spacing)
+# IdentStart IdentCont* as a single regular expression
+V.Identifier = Sequence(Capture(Regex(r'[a-zA-Z_][a-zA-Z_0-9]*')), V.Spacing)
+V.Integer = Sequence(Capture(Regex(r'[0-9]+')), V.Spacing)
 
 # Tokens
 
@@ -241,10 +259,14 @@ V.DOT = Sequence('.', V.Spacing)
 
 # Whitespace and comments
 
-V.Spacing = Star(Choice(V.Space, V.Comment))
+# Spacing <- (Space / Comment)* is consulted after every token, so it
+# is matched with a single regular expression; runs of whitespace are
+# consumed at once rather than one Space at a time, and the line break
+# ending a comment is consumed as whitespace
+V.Spacing = Regex(r'(?:[ \t\r\n]+|#[^\r\n]*)*')
 V.Space = Choice(Class(' \t'), V.EOL)
-V.Comment = Sequence('#', Star(Sequence(Not(V.EOL), Dot())), Optional(V.EOL))
-V.EOF = Not(Dot())
+V.Comment = Sequence('#', Star(Sequence(Not(V.EOL), _DOT)), Optional(V.EOL))
+V.EOF = Not(_DOT)
 V.EOL = Choice('\r\n', '\n', '\r')
 
 PEG = Grammar(
@@ -258,8 +280,6 @@ PEG = Grammar(
         'AND': Constant(And),
         'NOT': Constant(Not),
         'TILDE': Constant(Capture),
-        'Binding': _make_binder,
-        'Quantified': _make_quantified,
         'QUESTION': Constant(Optional),
         'STAR': Constant(Star),
         'PLUS': Constant(Plus),
@@ -269,7 +289,7 @@ PEG = Grammar(
         'Literal': _make_literal,
         'Class': _make_class,
         'LEFTANGLE': Constant(AutoIgnore),
-        'DOT': Constant(Dot()),
+        'DOT': Constant(_DOT),
         'RangeEndWarn': Warn(
             'The second character in a range may be an unescaped "]", '
             'but this is often a mistake. Silence this warning by '
@@ -278,27 +298,69 @@ PEG = Grammar(
     }
 )
 
-_parser = PackratParser(PEG)
+# the parsers are built on first use so importing pe stays cheap
+_parser: Union[PackratParser, None] = None
+_quiet_parser: Union[PackratParser, None] = None
+
+
+def _get_parser(warn: bool = True) -> PackratParser:
+    global _parser, _quiet_parser
+    if not warn:
+        # reparsing only reports the failure, so it must not warn again
+        if _quiet_parser is None:
+            actions = dict(PEG.actions)
+            del actions['RangeEndWarn']
+            _quiet_parser = PackratParser(
+                Grammar(definitions=V,
+                        actions=actions,
+                        start=PEG.start),
+                flags=Flag.INLINE | Flag.COMMON)
+        return _quiet_parser
+    if _parser is None:
+        _parser = PackratParser(PEG, flags=Flag.INLINE | Flag.COMMON)
+    return _parser
+
+
+def _cacheable(source: str) -> bool:
+    """Return `True` if loading *source* cannot emit warnings."""
+    # RangeEndWarn only matches a "]" after a hyphen
+    return '-]' not in source
 
 
 def loads(source: str) -> Tuple[str, Dict[str, Definition]]:
     """Parse the PEG at *source* and return a list of definitions."""
-    if not source.strip():
+    if not source or source.isspace():
         raise GrammarError("empty grammar")
-    try:
-        m = _parser.match(source, flags=pe.STRICT | pe.MEMOIZE)
-    except ParseError as exc:
-        raise GrammarError("invalid grammar") from exc
+    if _cacheable(source):
+        start, defs = _loads(source)
+    else:
+        # warnings are only emitted when the source is parsed
+        start, defs = _loads.__wrapped__(source)
+    # the cached result is shared, so give each caller its own mapping
+    return start, dict(defs)
+
+
+# grammars are often loaded more than once (e.g., by pe.match()), so
+# the results of the most recent parses are kept
+@lru_cache(maxsize=32)
+def _loads(source: str) -> Tuple[str, Tuple[Tuple[str, Definition], ...]]:
+    # the grammar rarely backtracks, so a memo only helps to report
+    # the furthest failure; parse again with one if the first attempt
+    # fails, without repeating any warnings from the first attempt
+    m = _get_parser().match(source, flags=pe.NONE)
+    if not m:
+        try:
+            m = _get_parser(warn=False).match(
+                source, flags=pe.STRICT | pe.MEMOIZE)
+        except ParseError as exc:
+            raise GrammarError("invalid grammar") from exc
 
     if not m:
         raise Error('invalid grammar')
     defs = m.value()
     if isinstance(defs, Definition):
-        start = 'Start'
-        defmap = {'Start': defs}
+        return 'Start', (('Start', defs),)
     else:
         assert isinstance(defs, tuple)
         defs = cast(Tuple[Tuple[str, Definition], ...], defs)
-        start = defs[0][0]
-        defmap = dict(defs)
-    return start, defmap
+        return defs[0][0], defs
@@ -6,19 +6,25 @@ Inspired by Medeiros and Ierusalimschy, 2008, "A Parsing Machine for PEGs"
 
 """
 
-from typing import Union, Tuple, List, Dict, Optional, Any
+from typing import (
+    Union, Tuple, List, Dict, Set, Optional, Any, Pattern, Callable
+)
 from enum import IntEnum
+from collections import defaultdict
 import re
 
-from pe._constants import FAIL as FAILURE, Operator, Flag
+from pe._constants import (
+    FAIL as FAILURE, MAX_MEMO_SIZE, DEL_MEMO_SIZE, Operator, Flag
+)
 from pe._errors import Error, ParseError
 from pe._match import Match
 from pe._types import Memo
 from pe._definition import Definition
 from pe._grammar import Grammar
 from pe._parser import Parser
-from pe._optimize import optimize
+from pe._optimize import optimize, regex, compile_regex, retried
 from pe._autoignore import autoignore
+from pe._misc import class_table
 from pe.actions import Action, Bind
 from pe.operators import Rule
 from pe.patterns import DEFAULT_IGNORE
@@ -41,19 +47,20 @@ class OpCode(IntEnum):
     NOOP = 10
 
 
-# Alias these for performance and convenience
-FAIL = OpCode.FAIL
-PASS = OpCode.PASS
-BRANCH = OpCode.BRANCH
-COMMIT = OpCode.COMMIT
-UPDATE = OpCode.UPDATE
-RESTORE = OpCode.RESTORE
-FAILTWICE = OpCode.FAILTWICE
-CALL = OpCode.CALL
-RETURN = OpCode.RETURN
-JUMP = OpCode.JUMP
-SCAN = OpCode.SCAN
-NOOP = OpCode.NOOP
+# Alias these for performance and convenience; plain ints are used
+# because CPython compares them faster than IntEnum members
+FAIL = int(OpCode.FAIL)
+PASS = int(OpCode.PASS)
+BRANCH = int(OpCode.BRANCH)
+COMMIT = int(OpCode.COMMIT)
+UPDATE = int(OpCode.UPDATE)
+RESTORE = int(OpCode.RESTORE)
+FAILTWICE = int(OpCode.FAILTWICE)
+CALL = int(OpCode.CALL)
+RETURN = int(OpCode.RETURN)
+JUMP = int(OpCode.JUMP)
+SCAN = int(OpCode.SCAN)
+NOOP = int(OpCode.NOOP)
 
 
 class Scanner:
@@ -69,22 +76,24 @@ class Scanner:
 
 _State = Tuple[int, int, int, int, int, int]  # (opidx, pos, count, mark, argidx, kwidx)
 _Binding = Tuple[str, Any]
+_Scan = Callable[[str, int, int], int]
 _Instruction = Tuple[
-    OpCode,
+    int,                # opcode
     int,                # index argument
     Optional[Scanner],  # scanner object or None
     int,                # max count
     bool,               # marking
     bool,               # capturing
     Optional[Action],   # rule action
-    Optional[str]       # name
+    Optional[str],      # name
+    Optional[_Scan],    # bound scanning method of the scanner
 ]
 _Program = List[_Instruction]
 _Index = Dict[str, int]
 
 
 def Instruction(
-    opcode: OpCode,
+    opcode: int,
     oploc: int = 1,
     scanner: Optional[Scanner] = None,
     maxcount: int = 1,
@@ -93,7 +102,8 @@ def Instruction(
     action: Optional[Action] = None,
     name: Optional[str] = None,
 ) -> _Instruction:
-    return (opcode, oploc, scanner, maxcount, marking, capturing, action, name)
+    return (opcode, oploc, scanner, maxcount, marking, capturing, action, name,
+            None)
 
 
 class MachineParser(Parser):
@@ -116,6 +126,18 @@ class MachineParser(Parser):
         pi, index = _make_program(grammar)
         self.pi: _Program = pi
         self._index = index
+        self._start_idx = index[grammar.start]
+        self._start_defn = self.grammar[self.start]
+        # memoization only pays for rules that may be tried again at the
+        # same position, and not for those that are a single scan
+        self._memoized: Set[int] = {
+            index[name] for name in retried(grammar.definitions)
+            if not (pi[index[name]][0] == SCAN
+                    and pi[index[name] + 1][0] == RETURN)
+        }
+        self._match = _match
+        if flags & Flag.SPECIALIZE:
+            self._match = _specialize(pi, self._memoized)
 
     @property
     def start(self):
@@ -129,10 +151,13 @@ class MachineParser(Parser):
               pos: int = 0,
               flags: Flag = Flag.NONE) -> Union[Match, None]:
         memo: Union[Memo, None] = None
+        if flags & Flag.MEMOIZE and self._memoized:
+            memo = defaultdict(dict)
         args: List[Any] = []
         kwargs: List[_Binding] = []
-        idx = self._index[self.start]
-        end = _match(self.pi, idx, s, pos, args, kwargs, memo)
+        end = self._match(
+            self.pi, self._start_idx, s, pos, args, kwargs, memo, self._memoized
+        )
         if end < 0:
             if flags & Flag.STRICT:
                 raise ParseError()
@@ -142,9 +167,9 @@ class MachineParser(Parser):
                 s,
                 pos,
                 end,
-                self.grammar[self.start],
-                args,
-                dict(kwargs)
+                self._start_defn,
+                tuple(args) if args else None,
+                dict(kwargs) if kwargs else None,
             )
 
 
@@ -156,46 +181,72 @@ def _match(  # noqa: C901
     args: List[Any],
     kwargs: List[_Binding],
     memo: Optional[Memo],
+    memoized: Set[int],
 ) -> int:
-    if s is None:
-        raise TypeError
-    if args is None:
-        raise TypeError
-    if kwargs is None:
-        raise TypeError
-
     stack: List[_State] = [
         (0, 0, 0, -1, 0, 0),    # failure (top-level backtrack entry)
-        (-1, -1, 1, -1, 0, 0),  # success
+        (-1, -1, 0, -1, 0, 0),  # success
     ]
 
     # lookup optimizations
     push = stack.append
     pop = stack.pop
     slen = len(s)
+    nargs = len(args)  # len(args) and len(kwargs), tracked in the loop
+    nkwargs = len(kwargs)
 
     while stack:
         # print(idx, pos, s[pos], len(stack))
         # print(pi[idx])
-        opcode, oploc, scanner, maxcount, marking, capturing, action, name = pi[idx]
+        opcode, oploc, _, maxcount, marking, capturing, action, _, scan = pi[idx]
 
         if marking:
-            push((0, -1, 0, pos, len(args), len(kwargs)))
+            push((0, -1, 0, pos, nargs, nkwargs))
 
         if opcode == SCAN:
-            assert scanner is not None
-            pos = scanner._scan(s, pos, slen)
+            pos = scan(s, pos, slen)  # type: ignore
             if pos < 0:
                 idx = FAILURE
 
         elif opcode == BRANCH:
-            push((idx + oploc, pos, 0, -1, len(args), len(kwargs)))
+            push((idx + oploc, pos, 0, -1, nargs, nkwargs))
             idx += 1
             continue
 
         elif opcode == CALL:
-            push((idx + 1, -1, 0, -1, -1, -1))
-            idx = oploc
+            if memo is None or oploc not in memoized:
+                push((idx + 1, -1, 0, -1, -1, -1))
+                idx = oploc
+                continue
+            entry = memo[pos].get(oploc)
+            if entry is None:
+                # the rule's frame keeps what RETURN needs to memoize it
+                push((idx + 1, -1, oploc, pos, nargs, nkwargs))
+                idx = oploc
+                continue
+            end, _args, _kwargs = entry
+            if end < 0:
+                idx = FAILURE
+            else:
+                pos = end
+                args.extend(_args)
+                nargs += len(_args)
+                if _kwargs:
+                    kwargs.extend(_kwargs.items())
+                    nkwargs += len(_kwargs)
+
+        elif opcode == RETURN:
+            idx, _, rule, start, argidx, kwidx = pop()
+            if rule:
+                assert memo is not None
+                # most rules bind nothing, so skip slicing when empty
+                memo[start][rule] = (
+                    pos,
+                    tuple(args[argidx:]) if nargs > argidx else (),
+                    dict(kwargs[kwidx:]) if nkwargs > kwidx else None,
+                )
+                if len(memo) > MAX_MEMO_SIZE:
+                    _trim_memo(memo)
             continue
 
         elif opcode == COMMIT:
@@ -206,7 +257,7 @@ def _match(  # noqa: C901
         elif opcode == UPDATE:
             next_idx, _, count, prev_mark, _, _ = pop()
             if maxcount == -1 or count < maxcount:
-                push((next_idx, pos, count + 1, prev_mark, len(args), len(kwargs)))
+                push((next_idx, pos, count + 1, prev_mark, nargs, nkwargs))
                 idx += oploc
             else:
                 idx += 1
@@ -221,10 +272,6 @@ def _match(  # noqa: C901
             pos = pop()[1]
             idx = FAILURE
 
-        elif opcode == RETURN:
-            idx = pop()[0]
-            continue
-
         elif opcode == PASS:
             break
 
@@ -235,17 +282,27 @@ def _match(  # noqa: C901
             raise Error(f'invalid operation: {opcode}')
 
         if idx == FAILURE:
-            idx, pos, _, _, argidx, kwidx = pop()
+            idx, pos, rule, start, argidx, kwidx = pop()
             while pos < 0:  # pos is >= 0 only for backtracking entries
-                idx, pos, _, _, argidx, kwidx = pop()
-            args[argidx:] = []
+                if rule:  # a memoized rule failed
+                    assert memo is not None
+                    memo[start][rule] = (FAILURE, (), None)
+                    if len(memo) > MAX_MEMO_SIZE:
+                        _trim_memo(memo)
+                idx, pos, rule, start, argidx, kwidx = pop()
+            del args[argidx:]
             if kwargs:
-                kwargs[kwidx:] = []
+                del kwargs[kwidx:]
+            nargs = argidx
+            nkwargs = kwidx
         else:
             if capturing:
                 _, _, _,  mark, argidx, kwidx = pop()
-                args[argidx:] = [s[mark:pos]]
-                kwargs[kwidx:] = []
+                del args[argidx:]
+                args.append(s[mark:pos])
+                del kwargs[kwidx:]
+                nargs = argidx + 1
+                nkwargs = kwidx
 
             if action:
                 _, _, _, mark, argidx, kwidx = pop()
@@ -254,13 +311,16 @@ def _match(  # noqa: C901
                     mark,
                     pos,
                     args[argidx:],
-                    dict(kwargs[kwidx:])
+                    dict(kwargs[kwidx:]) if nkwargs > kwidx else {}
                 )
                 args[argidx:] = _args
+                nargs = argidx + len(_args)
                 if not _kwargs:
-                    kwargs[kwidx:] = []
+                    del kwargs[kwidx:]
+                    nkwargs = kwidx
                 else:
                     kwargs[kwidx:] = _kwargs.items()
+                    nkwargs = kwidx + len(_kwargs)
 
             idx += 1
 
@@ -269,12 +329,221 @@ def _match(  # noqa: C901
     return pos
 
 
+def _trim_memo(memo: Memo) -> None:
+    """Drop the lowest positions from a memo that grew too large."""
+    for pos in sorted(memo)[:DEL_MEMO_SIZE]:
+        del memo[pos]
+
+
+# Code Generation ######################################################
+
+def _specialize(pi: _Program, memoized: Set[int]) -> Callable[..., int]:
+    """
+    Generate a version of :func:`_match` for the program *pi*.
+
+    Instructions are grouped into blocks that start where the machine
+    may jump, call, or backtrack to. Each block is compiled to
+    straight-line code with the program's operands inlined, so the
+    generated function only dispatches when it jumps, rather than on
+    every instruction.
+    """
+    last = len(pi) - 1
+    labels = {0, 1, last}
+    for i, (opcode, oploc, *_) in enumerate(pi):
+        if opcode in (BRANCH, COMMIT, UPDATE, RESTORE, JUMP):
+            labels.add(i + oploc)
+        elif opcode == CALL:
+            labels.add(i + 1)
+        elif opcode == RETURN:  # a rule starts after each return
+            labels.add(i + 1)
+    consts: Dict[str, Any] = {'Error': Error, '_trim_memo': _trim_memo}
+    lines = [
+        'def _match(pi, idx, s, pos, args, kwargs, memo, memoized):',
+        f'    stack = [(0, 0, 0, -1, 0, 0), ({last}, -1, 0, -1, 0, 0)]',
+        '    push = stack.append',
+        '    pop = stack.pop',
+        '    slen = len(s)',
+        '    while True:',
+        f'        if idx == {FAILURE}:',
+        '            idx, pos, rule, start, argidx, kwidx = pop()',
+        '            while pos < 0:',
+        '                if rule:',
+        f'                    memo[start][rule] = ({FAILURE}, (), None)',
+        f'                    if len(memo) > {MAX_MEMO_SIZE}:',
+        '                        _trim_memo(memo)',
+        '                idx, pos, rule, start, argidx, kwidx = pop()',
+        '            del args[argidx:]',
+        '            if kwargs:',
+        '                del kwargs[kwidx:]',
+    ]
+    _dispatch(pi, sorted(labels), labels, memoized, consts, lines, 2)
+    namespace = dict(consts)
+    exec(compile('\n'.join(lines), '<pe-machine>', 'exec'), namespace)
+    return namespace['_match']
+
+
+def _dispatch(pi, order, labels, memoized, consts, lines, depth):
+    ind = '    ' * depth
+    if len(order) == 1:
+        _block(pi, order[0], labels, memoized, consts, lines, depth)
+    else:
+        mid = len(order) // 2
+        lines.append(f'{ind}if idx < {order[mid]}:')
+        _dispatch(pi, order[:mid], labels, memoized, consts, lines, depth + 1)
+        lines.append(f'{ind}else:')
+        _dispatch(pi, order[mid:], labels, memoized, consts, lines, depth + 1)
+
+
+def _block(pi, i, labels, memoized, consts, lines, depth):  # noqa: C901
+    ind = '    ' * depth
+    fail = [f'{ind}    idx = {FAILURE}', f'{ind}    continue']
+    if i == 0:
+        # the top-level failure entry was popped
+        lines.append(f'{ind}return {FAILURE}')
+        return
+    while True:
+        (opcode, oploc, _, maxcount,
+         marking, capturing, action, _, scan) = pi[i]
+        # a scan that captures or acts on its own match pops its mark
+        # in the same step, so the mark is kept in a local instead
+        local = marking and opcode == SCAN and (capturing or action)
+        if local:
+            lines.append(f'{ind}mark = pos')
+        elif marking:
+            lines.append(f'{ind}push((0, -1, 0, pos, len(args), len(kwargs)))')
+        if opcode == SCAN:
+            name = f'_s{i}'
+            consts[name] = scan
+            lines.append(f'{ind}pos = {name}(s, pos, slen)')
+            lines.append(f'{ind}if pos < 0:')
+            lines.extend(fail)
+        elif opcode == BRANCH:
+            lines.append(f'{ind}push(({i + oploc}, pos, 0, -1,'
+                         ' len(args), len(kwargs)))')
+        elif opcode == CALL:
+            if oploc not in memoized:
+                lines.append(f'{ind}push(({i + 1}, -1, 0, -1, -1, -1))')
+                lines.append(f'{ind}idx = {oploc}')
+                lines.append(f'{ind}continue')
+                return
+            lines.extend([
+                f'{ind}if memo is None:',
+                f'{ind}    push(({i + 1}, -1, 0, -1, -1, -1))',
+                f'{ind}    idx = {oploc}',
+                f'{ind}    continue',
+                f'{ind}entry = memo[pos].get({oploc})',
+                f'{ind}if entry is None:',
+                f'{ind}    push(({i + 1}, -1, {oploc}, pos,'
+                ' len(args), len(kwargs)))',
+                f'{ind}    idx = {oploc}',
+                f'{ind}    continue',
+                f'{ind}end, _args, _kwargs = entry',
+                f'{ind}if end < 0:',
+                *fail,
+                f'{ind}pos = end',
+                f'{ind}args.extend(_args)',
+                f'{ind}if _kwargs:',
+                f'{ind}    kwargs.extend(_kwargs.items())',
+            ])
+        elif opcode == RETURN:
+            lines.extend([
+                f'{ind}idx, _, rule, start, argidx, kwidx = pop()',
+                f'{ind}if rule:',
+                f'{ind}    memo[start][rule] = (',
+                f'{ind}        pos,',
+                f'{ind}        tuple(args[argidx:]) if len(args) > argidx else (),',
+                f'{ind}        dict(kwargs[kwidx:]) if len(kwargs) > kwidx else None,',
+                f'{ind}    )',
+                f'{ind}    if len(memo) > {MAX_MEMO_SIZE}:',
+                f'{ind}        _trim_memo(memo)',
+                f'{ind}continue',
+            ])
+            return
+        elif opcode == COMMIT:
+            lines.append(f'{ind}pop()')
+            lines.append(f'{ind}idx = {i + oploc}')
+            lines.append(f'{ind}continue')
+            return
+        elif opcode == UPDATE:
+            lines.append(f'{ind}next_idx, _, count, prev_mark, _, _ = pop()')
+            push = ('push((next_idx, pos, count + 1, prev_mark,'
+                    ' len(args), len(kwargs)))')
+            if maxcount == -1:
+                lines.append(f'{ind}{push}')
+                lines.append(f'{ind}idx = {i + oploc}')
+                lines.append(f'{ind}continue')
+                return
+            lines.append(f'{ind}if count < {maxcount}:')
+            lines.append(f'{ind}    {push}')
+            lines.append(f'{ind}    idx = {i + oploc}')
+            lines.append(f'{ind}    continue')
+        elif opcode == RESTORE:
+            lines.append(f'{ind}pos = pop()[1]')
+            lines.append(f'{ind}idx = {i + oploc}')
+            lines.append(f'{ind}continue')
+            return
+        elif opcode == FAILTWICE:
+            lines.append(f'{ind}pos = pop()[1]')
+            lines.append(f'{ind}idx = {FAILURE}')
+            lines.append(f'{ind}continue')
+            return
+        elif opcode == PASS:
+            lines.append(f'{ind}return pos')
+            return
+        elif opcode == FAIL:
+            lines.append(f'{ind}idx = {FAILURE}')
+            lines.append(f'{ind}continue')
+            return
+        elif opcode != NOOP:
+            raise Error(f'invalid operation: {opcode}')
+
+        if capturing and local:
+            lines.append(f'{ind}args.append(s[mark:pos])')
+            local = False
+        elif capturing:
+            lines.append(f'{ind}_, _, _, mark, argidx, kwidx = pop()')
+            lines.append(f'{ind}del args[argidx:]')
+            lines.append(f'{ind}args.append(s[mark:pos])')
+            lines.append(f'{ind}del kwargs[kwidx:]')
+        if action:
+            name = f'_a{i}'
+            consts[name] = action
+        if action and local:
+            lines.extend([
+                f'{ind}_args, _kwargs = {name}(s, mark, pos, [], {{}})',
+                f'{ind}args.extend(_args)',
+                f'{ind}if _kwargs:',
+                f'{ind}    kwargs.extend(_kwargs.items())',
+            ])
+        elif action:
+            lines.extend([
+                f'{ind}_, _, _, mark, argidx, kwidx = pop()',
+                f'{ind}_args, _kwargs = {name}(',
+                f'{ind}    s, mark, pos, args[argidx:],',
+                f'{ind}    dict(kwargs[kwidx:]) if len(kwargs) > kwidx else {{}}',
+                f'{ind})',
+                f'{ind}args[argidx:] = _args',
+                f'{ind}if not _kwargs:',
+                f'{ind}    del kwargs[kwidx:]',
+                f'{ind}else:',
+                f'{ind}    kwargs[kwidx:] = _kwargs.items()',
+            ])
+        i += 1
+        if i in labels:
+            lines.append(f'{ind}idx = {i}')
+            lines.append(f'{ind}continue')
+            return
+
+
 # Program Creation #####################################################
 
 # Captures and actions cannot be placed on these operators because of
 # their effect on the stack
 NO_CAP_OR_ACT = {CALL, COMMIT, UPDATE, RESTORE, FAILTWICE, RETURN}
 
+# These operators jump relative to their own location
+JUMPS = {BRANCH, COMMIT, UPDATE, RESTORE, JUMP}
+
 
 def _make_program(grammar) -> Tuple[_Program, _Index]:
     """A "program" is a set of instructions and mappings."""
@@ -287,8 +556,11 @@ def _make_program(grammar) -> Tuple[_Program, _Index]:
         _pis = _parsing_instructions(grammar[name])
         pis.extend(_pis)
         pis.append(Instruction(RETURN))
-    # replace call symbols with locations
-    pis = [(pi[0], index[pi[7]], *pi[2:]) if pi[0] == CALL else pi
+    # replace call symbols with locations and bind scanning methods so
+    # steps do not look them up
+    pis = [(pi[0], index[pi[7]], *pi[2:]) if pi[0] == CALL
+           else (*pi[:8], pi[2]._scan) if pi[2] is not None
+           else pi
            for pi in pis]
     pis.append(Instruction(PASS))  # success condition
 
@@ -300,7 +572,10 @@ def _dot(defn):
 
 
 def _lit(defn):
-    return [Instruction(SCAN, scanner=Literal(defn.args[0]))]
+    x = defn.args[0]
+    if len(x) == 1:
+        return [Instruction(SCAN, scanner=Character(x))]
+    return [Instruction(SCAN, scanner=Literal(x))]
 
 
 def _cls(defn, mincount=1, maxcount=1):
@@ -352,10 +627,18 @@ def _loop(defn, mincount: int, maxcount: int):
                             marking=pi[4],
                             capturing=pi[5],
                             action=pi[6])]
-    return [*(pis * mincount),  # risk of billion laughs attack
+    head = pis * mincount  # risk of billion laughs attack
+    if maxcount == -1:
+        loopmax = -1
+    elif maxcount > mincount:
+        # UPDATE counts the repetitions after the first in the loop
+        loopmax = maxcount - mincount - 1
+    else:
+        return head or [Instruction(NOOP)]
+    return [*head,
             Instruction(BRANCH, len(pis) + 2),
             *pis,
-            Instruction(UPDATE, -len(pis), maxcount=maxcount)]
+            Instruction(UPDATE, -len(pis), maxcount=loopmax)]
 
 
 def _sym(defn):
@@ -378,8 +661,8 @@ def _not(defn):
 
 
 def _cap(defn):
-    captured_choice = defn.args[0].op == Operator.CHC
     pis = _parsing_instructions(defn.args[0])
+    skipped = _jumps_past(pis)
     if not pis[0][4]:
         pis[0] = (*pis[0][:4], True, *pis[0][5:])
     else:
@@ -388,7 +671,7 @@ def _cap(defn):
     if (not pi[5]  # not capturing
             and not pi[6]  # no action
             and pi[0] not in NO_CAP_OR_ACT
-            and not captured_choice):
+            and not skipped):
         pis[-1] = (*pi[:5], True, *pi[6:])
     else:
         pis.append(Instruction(NOOP, capturing=True))
@@ -400,11 +683,33 @@ def _bnd(defn):
 
 
 def _seq(defn):
-    head = [pi
-            for d in defn.args[0][:-1]
-            for pi in _parsing_instructions(d)]
-    tail = _parsing_instructions(defn.args[0][-1])
-    return head + tail
+    pis: List[_Instruction] = []
+    fusable = False
+    for d in defn.args[0]:
+        _pis = _parsing_instructions(d)
+        # Runs of plain scans are fused into a single scan; only
+        # single-instruction terms are considered so no jump can land
+        # inside the run.
+        if len(_pis) == 1 and _plain_scan(_pis[0]):
+            if fusable:
+                pis[-1] = Instruction(SCAN, scanner=_fuse(pis[-1][2], _pis[0][2]))
+                continue
+            fusable = True
+        else:
+            fusable = False
+        pis.extend(_pis)
+    return pis
+
+
+def _plain_scan(pi: _Instruction) -> bool:
+    return pi[0] == SCAN and not (pi[4] or pi[5]) and pi[6] is None
+
+
+def _fuse(a: Optional[Scanner], b: Optional[Scanner]) -> Scanner:
+    assert a is not None and b is not None
+    if isinstance(a, Sequence):
+        return Sequence([*a._scanners, b])
+    return Sequence([a, b])
 
 
 def _chc(defn):
@@ -419,18 +724,27 @@ def _chc(defn):
     return pi
 
 
+def _jumps_past(pis) -> bool:
+    # if anything jumps to just past the last instruction, as choices and
+    # lookaheads do, the last one does not run on every successful match
+    n = len(pis)
+    return any(pi[0] in JUMPS and i + pi[1] == n
+               for i, pi in enumerate(pis))
+
+
 def _rul(defn):
     subdefn, action, _ = defn.args
     pis = _parsing_instructions(subdefn)
     if action is None:
         return pis
+    skipped = _jumps_past(pis)
     pi = pis[0]
     if not pi[4]:
         pis[0] = (*pi[:4], True, *pi[5:])
     else:
         pis.insert(0, Instruction(NOOP, marking=True))
     pi = pis[-1]
-    if not pi[6] and pi[0] not in NO_CAP_OR_ACT:
+    if not pi[6] and pi[0] not in NO_CAP_OR_ACT and not skipped:
         pis[-1] = (*pi[:6], action, *pi[7:])
     else:
         pis.append(Instruction(NOOP, action=action))
@@ -458,11 +772,11 @@ _op_map = {
 
 
 def _parsing_instructions(defn):  # noqa: C901
-    op = defn.op
-    if op in _op_map:
-        return _op_map[defn.op](defn)
-    else:
-        raise Error(f'invalid definition: {defn!r}')
+    try:
+        func = _op_map[defn.op]
+    except KeyError:
+        raise Error(f'invalid definition: {defn!r}') from None
+    return func(defn)
 
 
 # Scanners #############################################################
@@ -481,15 +795,24 @@ class Literal(Scanner):
         self._xlen = len(x)
 
     def _scan(self, s: str, pos: int, slen: int) -> int:
-        end = pos + self._xlen
-        if s[pos:end] != self._x:
+        # startswith() compares in place instead of slicing a copy
+        if not s.startswith(self._x, pos):
             return FAILURE
-        return end
+        return pos + self._xlen
 
     def __repr__(self):
         return f'{self.__class__.__name__}({self._x!r})'
 
 
+class Character(Literal):
+    """Literal of exactly one character."""
+
+    def _scan(self, s: str, pos: int, slen: int) -> int:
+        if pos < slen and s[pos] == self._x:
+            return pos + 1
+        return FAILURE
+
+
 class CharacterClass(Scanner):
 
     def __init__(
@@ -502,11 +825,38 @@ class CharacterClass(Scanner):
         self._chars = ''.join(a for a, b in ranges if not b)
         self._ranges = ''.join(a+b for a, b in ranges if b)
         self._rangelen = len(self._ranges)
+        self._table = class_table(ranges)
+        # runs of more than one character are scanned by the re module
+        # in one call; the counts are set after the scanner is created,
+        # so the pattern is compiled when it is first used
+        self._pattern: Optional[str] = None
+        self._run: Optional[Pattern[str]] = None
+        if ranges:
+            cls = Definition(Operator.CLS, (ranges, negate))
+            self._pattern = regex(cls).args[0]
         self._negate = negate
         self.mincount = mincount
         self.maxcount = maxcount
 
     def _scan(self, s: str, pos: int, slen: int) -> int:
+        if self.maxcount != 1 and self._pattern is not None:
+            run = self._run
+            if run is None:
+                maxcount = '' if self.maxcount == -1 else self.maxcount
+                run = self._run = re.compile(
+                    f'{self._pattern}{{{self.mincount},{maxcount}}}'
+                )
+            m = run.match(s, pos)
+            return m.end() if m else FAILURE
+        if self.maxcount == 1 and pos < slen:
+            # most classes match a single character, which is looked up
+            # directly when it is in the table
+            o = ord(s[pos])
+            if o < 256:
+                if self._table[o] ^ self._negate:
+                    return pos + 1
+                return pos if self.mincount < 1 else FAILURE
+        table = self._table
         ranges = self._ranges
         rangelen = self._rangelen
         mincount = self.mincount
@@ -514,12 +864,16 @@ class CharacterClass(Scanner):
         i = 0
         while maxcount and pos < slen:
             c = s[pos]
-            matched = c in self._chars
-            while i < rangelen:
-                if ranges[i] <= c <= ranges[i+1]:
-                    matched = True
-                    break
-                i += 2
+            o = ord(c)
+            if o < 256:
+                matched = table[o]
+            else:
+                matched = c in self._chars
+                while i < rangelen:
+                    if ranges[i] <= c <= ranges[i+1]:
+                        matched = True
+                        break
+                    i += 2
             if matched ^ self._negate:
                 pos += 1
                 maxcount -= 1
@@ -542,12 +896,29 @@ class CharacterClass(Scanner):
                 f' maxcount={self.maxcount})')
 
 
+class Sequence(Scanner):
+
+    def __init__(self, scanners: List[Scanner]):
+        self._scanners = scanners
+
+    def _scan(self, s: str, pos: int, slen: int) -> int:
+        for scanner in self._scanners:
+            pos = scanner._scan(s, pos, slen)
+            if pos < 0:
+                return FAILURE
+        return pos
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self._scanners!r})'
+
+
 class Regex(Scanner):
     def __init__(self, pattern: str, flags: int = 0):
-        self._regex = re.compile(pattern, flags=flags)
+        self._regex = compile_regex(pattern, flags=flags)
+        self._match = self._regex.match
 
     def _scan(self, s: str, pos: int, slen: int) -> int:
-        m = self._regex.match(s, pos=pos)
+        m = self._match(s, pos)
         if m is None:
             return FAILURE
         else:
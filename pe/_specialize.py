@@ -0,0 +1,240 @@
+"""
+Runtime Code Generation for Unstructured Expressions
+
+Expressions that do not emit or bind values (no nonterminals,
+captures, bindings, or actions) only need to compute an end position,
+so they can be translated into straight-line Python source, compiled,
+and called directly instead of walking a tree of matcher closures.
+
+The generated code records failures in the packrat memo for the same
+subexpressions as the matcher closures do, so error messages do not
+depend on whether an expression was specialized.
+"""
+
+from typing import Callable, List, Dict, Any
+
+from pe._constants import (
+    FAIL,
+    MAX_MEMO_SIZE,
+    DEL_MEMO_SIZE,
+    Operator,
+)
+from pe._definition import Definition
+from pe._types import RawMatch, Memo
+from pe._optimize import regex, compile_regex
+
+
+DOT = Operator.DOT
+LIT = Operator.LIT
+CLS = Operator.CLS
+RGX = Operator.RGX
+OPT = Operator.OPT
+STR = Operator.STR
+PLS = Operator.PLS
+RPT = Operator.RPT
+AND = Operator.AND
+NOT = Operator.NOT
+SEQ = Operator.SEQ
+
+_Matcher = Callable[[str, int, Memo], RawMatch]
+
+# operators that can be specialized; choices are left to the packrat
+# parser, which only tries the alternatives that can start with the
+# next character
+SPECIALIZABLE = {DOT, LIT, CLS, RGX, OPT, STR, PLS, RPT, AND, NOT, SEQ}
+
+
+def specializable(defn: Definition) -> bool:
+    """Return `True` if *defn* can be compiled with :func:`specialize`."""
+    op = defn.op
+    if op not in SPECIALIZABLE:
+        return False
+    elif op == SEQ:
+        return all(specializable(d) for d in defn.args[0])
+    elif op.type == 'Primary':
+        return True
+    else:
+        return specializable(defn.args[0])
+
+
+def specialize(defn: Definition) -> _Matcher:
+    """
+    Compile *defn* into a packrat matcher.
+
+    The matcher returns the same results as the packrat parser's
+    matchers for *defn* and leaves the same failures in the memo.
+    """
+    if not specializable(defn):
+        raise ValueError(f'cannot specialize {defn.op}')
+    gen = _Generator()
+    lines = ['def _match(s, pos, memo):',
+             '    slen = len(s)',
+             '    _f = None']
+    gen.emit(defn, lines, 1)
+    lines.append('    if pos < 0:')
+    lines.append(f'        return {FAIL}, _f, None')
+    lines.append('    return pos, (), None')
+    namespace: Dict[str, Any] = dict(gen.constants)
+    exec(compile('\n'.join(lines), '<pe-specialized>', 'exec'), namespace)
+    return namespace['_match']
+
+
+class _Generator:
+    """
+    Emit statements for a definition.
+
+    The emitted statements assume `pos >= 0` on entry and leave `pos`
+    at the end of the match, or at `FAIL` if the match failed, in which
+    case `_f` holds the failure, as the arguments of a failed match.
+    """
+
+    def __init__(self):
+        self.constants: Dict[str, Any] = {}
+        self._n = 0
+
+    def _var(self, prefix: str) -> str:
+        self._n += 1
+        return f'{prefix}{self._n}'
+
+    def _const(self, value: Any) -> str:
+        name = self._var('_k')
+        self.constants[name] = value
+        return name
+
+    def _key(self) -> int:
+        # a memo key like the id() of a matcher closure; the object is
+        # kept alive so its id cannot be reused
+        key = object()
+        self._const(key)
+        return id(key)
+
+    def emit(self, defn: Definition, lines: List[str], depth: int) -> None:
+        getattr(self, f'_{defn.op.name.lower()}')(defn, lines, depth)
+
+    def _terminal(self, defn, test, advance, lines, depth):
+        # terminals record their failures, as in PackratParser._terminal()
+        ind = '    ' * depth
+        failed = self._const(regex(defn))
+        lines.append(f'{ind}if {test}:')
+        lines.append(f'{ind}    {advance}')
+        lines.append(f'{ind}else:')
+        lines.append(f'{ind}    _f = (pos, {failed})')
+        lines.append(f'{ind}    if memo is not None:')
+        # as in PackratParser._choice(), old positions are dropped
+        lines.append(f'{ind}        if len(memo) > {MAX_MEMO_SIZE}:')
+        lines.append(f'{ind}            for _q in sorted(memo)[:{DEL_MEMO_SIZE}]:')
+        lines.append(f'{ind}                del memo[_q]')
+        lines.append(f'{ind}        memo[pos][{self._key()}] = ({FAIL}, _f, None)')
+        lines.append(f'{ind}    pos = {FAIL}')
+
+    def _dot(self, defn, lines, depth):
+        self._terminal(defn, 'pos < slen', 'pos += 1', lines, depth)
+
+    def _lit(self, defn, lines, depth):
+        string = defn.args[0]
+        self._terminal(defn,
+                       f's.startswith({string!r}, pos)',
+                       f'pos += {len(string)}',
+                       lines,
+                       depth)
+
+    def _cls(self, defn, lines, depth):
+        ranges, negate = defn.args
+        chars = ''.join(a for a, b in ranges if not b)
+        tests = [f'{a!r} <= c <= {b!r}' for a, b in ranges if b]
+        if chars:
+            tests.insert(0, f'c in {chars!r}')
+        test = ' or '.join(tests) or 'False'
+        if negate:
+            test = f'not ({test})'
+        # c is '' at the end of input, which is in every string
+        ind = '    ' * depth
+        lines.append(f'{ind}c = s[pos:pos+1]')
+        self._terminal(defn, f'c and ({test})', 'pos += 1', lines, depth)
+
+    def _rgx(self, defn, lines, depth):
+        pattern, flags = defn.args
+        rgx = self._const(compile_regex(pattern, flags=flags))
+        ind = '    ' * depth
+        lines.append(f'{ind}m = {rgx}.match(s, pos)')
+        self._terminal(defn, 'm', 'pos = m.end()', lines, depth)
+
+    def _opt(self, defn, lines, depth):
+        ind = '    ' * depth
+        save = self._var('_p')
+        lines.append(f'{ind}{save} = pos')
+        self.emit(defn.args[0], lines, depth)
+        lines.append(f'{ind}if pos < 0:')
+        lines.append(f'{ind}    pos = {save}')
+
+    def _str(self, defn, lines, depth):
+        self._repeat(defn.args[0], 0, -1, lines, depth)
+
+    def _pls(self, defn, lines, depth):
+        self._repeat(defn.args[0], 1, -1, lines, depth)
+
+    def _rpt(self, defn, lines, depth):
+        self._repeat(*defn.args, lines, depth)
+
+    def _repeat(self, subdef, min, max, lines, depth):
+        # as in PackratParser._repetition(), at most one repetition per
+        # remaining character is counted, which also stops nullable
+        # expressions from repeating forever; the body is emitted once
+        # so its failures are recorded under the same keys each time
+        ind = '    ' * depth
+        save = self._var('_p')
+        cnt = self._var('_c')
+        guard = self._var('_g')
+        lines.append(f'{ind}{save} = pos')
+        lines.append(f'{ind}{guard} = slen - pos')
+        lines.append(f'{ind}{cnt} = 0')
+        lines.append(f'{ind}while True:')
+        self.emit(subdef, lines, depth + 1)
+        lines.append(f'{ind}    if pos < 0 or {guard} <= 0:')
+        lines.append(f'{ind}        break')
+        lines.append(f'{ind}    {cnt} += 1')
+        lines.append(f'{ind}    {save} = pos')
+        if max != -1:
+            lines.append(f'{ind}    if {cnt} == {max}:')
+            lines.append(f'{ind}        break')
+        lines.append(f'{ind}    {guard} -= 1')
+        if min > 0:
+            lines.append(f'{ind}if {cnt} < {min}:')
+            lines.append(f'{ind}    if pos >= 0:')  # stopped by the guard
+            lines.append(f'{ind}        _f = ()')
+            lines.append(f'{ind}    pos = {FAIL}')
+            lines.append(f'{ind}else:')
+            lines.append(f'{ind}    pos = {save}')
+        else:
+            lines.append(f'{ind}pos = {save}')
+
+    def _and(self, defn, lines, depth):
+        ind = '    ' * depth
+        save = self._var('_p')
+        lines.append(f'{ind}{save} = pos')
+        self.emit(defn.args[0], lines, depth)
+        lines.append(f'{ind}if pos >= 0:')
+        lines.append(f'{ind}    pos = {save}')
+
+    def _not(self, defn, lines, depth):
+        ind = '    ' * depth
+        save = self._var('_p')
+        failed = self._const(defn.args[0])
+        lines.append(f'{ind}{save} = pos')
+        self.emit(defn.args[0], lines, depth)
+        lines.append(f'{ind}if pos >= 0:')
+        lines.append(f'{ind}    _f = ({save}, {failed})')
+        lines.append(f'{ind}    pos = {FAIL}')
+        lines.append(f'{ind}else:')
+        lines.append(f'{ind}    pos = {save}')
+
+    def _seq(self, defn, lines, depth):
+        # a single-pass loop lets each item bail out with `break`
+        # without nesting deeper for every item in the sequence
+        ind = '    ' * depth
+        lines.append(f'{ind}while True:')
+        for subdef in defn.args[0]:
+            self.emit(subdef, lines, depth + 1)
+            lines.append(f'{ind}    if pos < 0:')
+            lines.append(f'{ind}        break')
+        lines.append(f'{ind}    break')
@@ -55,20 +55,21 @@ class Bind(Action):
         self.arg = name
 
     def __call__(self, s, pos, end, args, kwargs):
-        kwargs = dict(kwargs or [])
+        kwargs = {} if kwargs is None else dict(kwargs)
         kwargs[self.arg] = determine(args)
         return (), kwargs
 
 
 class Constant(Action):
 
-    __slots__ = ()
+    __slots__ = '_retval',
 
     def __init__(self, value):
         self.arg = value
+        self._retval = (value,), None  # the same result every time
 
     def __call__(self, s, pos, end, args, kwargs):
-        return (self.arg,), None
+        return self._retval
 
 
 class Pack(Action):
@@ -67,17 +67,16 @@ def Class(arg, negate: bool = False):
     else:
         assert isinstance(arg, str)
         ranges = []
+        n = len(arg)
         i = 0
-        while i < len(arg) - 2:
+        while i < n - 2:
             if arg[i+1] == '-':
                 ranges.append((arg[i], arg[i+2]))
                 i += 3
             else:
                 ranges.append((arg[i], None))
                 i += 1
-        while i < len(arg):
-            ranges.append((arg[i], None))
-            i += 1
+        ranges.extend((c, None) for c in arg[i:])
 
     return Definition(CLS, (ranges, negate))
 
@@ -87,31 +86,27 @@ def Regex(pattern: Union[str, Pattern], flags: int = 0):
 
 
 def Sequence(*expressions: _Def):
-    exprs = list(map(_validate, expressions))
-    if len(exprs) == 1:
-        return exprs[0]
-    else:
-        _exprs: List[Definition] = []
-        for expr in exprs:
-            if expr.op == SEQ:
-                _exprs.extend(expr.args[0])
-            else:
-                _exprs.append(expr)
-        return Definition(SEQ, (_exprs,))
+    if len(expressions) == 1:
+        return _validate(expressions[0])
+    _exprs: List[Definition] = []
+    for expr in map(_validate, expressions):
+        if expr.op == SEQ:
+            _exprs.extend(expr.args[0])
+        else:
+            _exprs.append(expr)
+    return Definition(SEQ, (_exprs,))
 
 
 def Choice(*expressions: _Def):
-    exprs = list(map(_validate, expressions))
-    if len(exprs) == 1:
-        return exprs[0]
-    else:
-        _exprs: List[Definition] = []
-        for expr in exprs:
-            if expr.op == CHC:
-                _exprs.extend(expr.args[0])
-            else:
-                _exprs.append(expr)
-        return Definition(CHC, (_exprs,))
+    if len(expressions) == 1:
+        return _validate(expressions[0])
+    _exprs: List[Definition] = []
+    for expr in map(_validate, expressions):
+        if expr.op == CHC:
+            _exprs.extend(expr.args[0])
+        else:
+            _exprs.append(expr)
+    return Definition(CHC, (_exprs,))
 
 
 def Optional(expression: _Def):
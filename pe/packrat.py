@@ -7,8 +7,20 @@ Packrat Parsing
 # NOTE: attempting to use exceptions instead of FAIL codes resulted in
 # almost a 2x slowdown, so it's probably not a good idea
 
-from typing import List, Dict, Callable, Iterable, Any, Optional
+from typing import (
+    List,
+    Dict,
+    Tuple,
+    Set,
+    FrozenSet,
+    Sequence,
+    Callable,
+    Iterable,
+    Any,
+    Optional,
+)
 from collections import defaultdict
+import sys
 import re
 import inspect
 
@@ -21,15 +33,18 @@ from pe._constants import (
 )
 from pe._errors import Error, ParseError
 from pe._definition import Definition
-from pe._match import Match, determine
+from pe._match import Match
 from pe._types import RawMatch, Memo
 from pe._grammar import Grammar
 from pe._parser import Parser
-from pe._optimize import optimize, regex
+from pe._optimize import (
+    optimize, regex, compile_regex, _references, _without_values
+)
 from pe._autoignore import autoignore
+from pe._specialize import specialize, specializable
 from pe._debug import debug
-from pe._misc import ansicolor
-from pe.actions import Action
+from pe._misc import ansicolor, class_table
+from pe.actions import Action, Constant
 from pe.patterns import DEFAULT_IGNORE
 
 
@@ -57,6 +72,8 @@ class PackratParser(Parser):
         self.modified_grammar = grammar
 
         self._exprs: Dict[str, Callable] = {}
+        self._numbers = _number_subexpressions(grammar)
+        self._shared: Dict[int, _Matcher] = {}
         self._grammar_to_packrat(grammar)
 
     @property
@@ -87,16 +104,23 @@ class PackratParser(Parser):
             else:
                 return None
 
-        args = tuple(args or ())
-        if kwargs is None:
-            kwargs = {}
-
-        return Match(s, pos, end, self.grammar[self.start], args, kwargs)
+        return Match(
+            s,
+            pos,
+            end,
+            self.grammar[self.start],
+            tuple(args) if args else None,
+            kwargs or None,
+        )
 
     def _grammar_to_packrat(self, grammar):
         exprs = self._exprs
-        for name, _def in grammar.definitions.items():
-            expr = self._def_to_expr(_def)
+        defs = grammar.definitions
+        # rules are built before the rules that refer to them, where
+        # recursion allows, so those references call them directly
+        # instead of through a placeholder Rule
+        for name in _definition_order(defs):
+            expr = self._def_to_expr(defs[name])
             # if name is already in exprs, that means it was seen as a
             # nonterminal in some other rule, so don't replace the object
             # or the call chain will break.
@@ -123,16 +147,31 @@ class PackratParser(Parser):
         if op == Operator.SYM:
             name = definition.args[0]
             return self._exprs.setdefault(name, Rule(name))
-        else:
-            if op in self._op_map:
-                return self._op_map[op](self, definition)
-            else:
-                raise Error(f'invalid definition: {definition!r}')
+        # equal subexpressions share a matcher, and so its memo entries
+        n = self._numbers.get(id(definition))
+        if n is None:
+            return self._make_expr(definition)
+        expr = self._shared.get(n)
+        if expr is None:
+            expr = self._shared[n] = self._make_expr(definition)
+        return expr
+
+    def _make_expr(self, definition: Definition) -> _Matcher:
+        op = definition.op
+        if (self.flags & Flag.SPECIALIZE
+                and op.type != 'Primary'
+                and specializable(definition)):
+            return specialize(definition)
+        try:
+            func = self._op_map[op]
+        except KeyError:
+            raise Error(f'invalid definition: {definition!r}') from None
+        return func(self, definition)
 
     def _terminal(self, definition: Definition) -> _Matcher:
 
         definition = regex(definition)
-        _re = re.compile(definition.args[0], flags=definition.args[1])
+        _re = compile_regex(definition.args[0], flags=definition.args[1])
 
         def _match(s: str, pos: int, memo: Memo) -> RawMatch:
             m = _re.match(s, pos)
@@ -142,9 +181,56 @@ class PackratParser(Parser):
             else:
                 retval = FAIL, (pos, definition), None
                 if memo is not None:
-                    memo[pos][id(_match)] = retval
+                    if len(memo) > MAX_MEMO_SIZE:
+                        _trim_memo(memo)
+                    memo[pos][_id] = retval
+            return retval
+
+        _id = id(_match)
+        return _match
+
+    def _literal(self, definition: Definition) -> _Matcher:
+        """A literal string; checked without the regular expression."""
+        string: str = definition.args[0]
+        length = len(string)
+        definition = regex(definition)
+
+        def _match(s: str, pos: int, memo: Memo) -> RawMatch:
+            if s.startswith(string, pos):
+                return pos + length, (), None
+            retval: RawMatch = (FAIL, (pos, definition), None)
+            if memo is not None:
+                if len(memo) > MAX_MEMO_SIZE:
+                    _trim_memo(memo)
+                memo[pos][_id] = retval
+            return retval
+
+        _id = id(_match)
+        return _match
+
+    def _class(self, definition: Definition) -> _Matcher:
+        """A character class; most characters are checked in a table."""
+        ranges, negate = definition.args
+        table = class_table(ranges)
+        definition = regex(definition)
+        _re = re.compile(definition.args[0], flags=definition.args[1])
+
+        def _match(s: str, pos: int, memo: Memo) -> RawMatch:
+            if pos < len(s):
+                o = ord(s[pos])
+                if o < 256:
+                    if table[o] ^ negate:
+                        return pos + 1, (), None
+                elif _re.match(s, pos):
+                    return pos + 1, (), None
+            retval: RawMatch = (FAIL, (pos, definition), None)
+            if memo is not None:
+                if len(memo) > MAX_MEMO_SIZE:
+                    _trim_memo(memo)
+                memo[pos][_id] = retval
             return retval
 
+        _id = id(_match)
         return _match
 
     def _sequence(self, definition: Definition) -> _Matcher:
@@ -152,6 +238,50 @@ class PackratParser(Parser):
         items: Iterable[Definition] = definition.args[0]
         expressions = [self._def_to_expr(defn) for defn in items]
 
+        # terminals emit nothing, so a sequence of them (e.g., a token
+        # followed by whitespace) needs no argument accumulation
+        if all(d.op.type == 'Primary' and d.op != Operator.SYM
+               for d in items):
+
+            def _match_terminals(s: str, pos: int, memo: Memo) -> RawMatch:
+                for expr in expressions:
+                    end, args, _ = expr(s, pos, memo)
+                    if end < 0:
+                        return FAIL, args, None
+                    pos = end
+                return pos, (), None
+
+            return _match_terminals
+
+        # when only one item can emit values (e.g., a nonterminal between
+        # tokens), its values are passed on as they are instead of being
+        # copied into a new tuple
+        valued = [i for i, d in enumerate(items)
+                  if d.op.type != 'Primary' or d.op == Operator.SYM]
+        if len(valued) == 1:
+            before = expressions[:valued[0]]
+            expression = expressions[valued[0]]
+            after = expressions[valued[0] + 1:]
+
+            def _match_one(s: str, pos: int, memo: Memo) -> RawMatch:
+                for expr in before:
+                    end, _args, _ = expr(s, pos, memo)
+                    if end < 0:
+                        return FAIL, _args, None
+                    pos = end
+                end, args, _kwargs = expression(s, pos, memo)
+                if end < 0:
+                    return FAIL, args, None
+                pos = end
+                for expr in after:
+                    end, _args, _ = expr(s, pos, memo)
+                    if end < 0:
+                        return FAIL, _args, None
+                    pos = end
+                return pos, args, dict(_kwargs) if _kwargs else {}
+
+            return _match_one
+
         def _match(s: str, pos: int, memo: Memo) -> RawMatch:
             args: List = []
             kwargs: Dict[str, Any] = {}
@@ -170,29 +300,85 @@ class PackratParser(Parser):
 
     def _choice(self, definition: Definition) -> _Matcher:
 
-        items: Iterable[Definition] = definition.args[0]
+        items: List[Definition] = definition.args[0]
         expressions = [self._def_to_expr(defn) for defn in items]
+        # alternatives that must start with a known character are only
+        # tried when the next character is one of them; the rest are
+        # always tried
+        defs = self.modified_grammar.definitions
+        table: Optional[Dict[str, Tuple[_Matcher, ...]]] = None
+        default: Tuple[_Matcher, ...] = ()
+        dispatch = _dispatch_table(items, expressions, defs)
+        # skipped alternatives are reported as failing where they would
+        # have, as if they had been tried
+        missed: Dict[str, List[Tuple[int, Definition]]] = {}
+        missed_default: List[Tuple[int, Definition]] = []
+        if dispatch is not None:
+            table, default = dispatch
+            expected = [(e, _expected(d, defs))
+                        for d, e in zip(items, expressions)]
+            missed = {c: _skipped(expected, alts)
+                      for c, alts in table.items()}
+            missed_default = _skipped(expected, default)
+
+        # a choice of plain terminals is cheaper to retry than to look
+        # up, so only its failures are recorded (for error messages)
+        if all(d.op.type == 'Primary' and d.op != Operator.SYM
+               for d in items):
+
+            def _match_terminals(s: str, pos: int, memo: Memo) -> RawMatch:
+                alternatives: Sequence[_Matcher]
+                if table is None:
+                    alternatives = expressions
+                else:
+                    c = s[pos:pos+1]
+                    alternatives = table.get(c, default)
+                for e in alternatives:
+                    retval = e(s, pos, memo)
+                    if retval[0] >= 0:
+                        return retval
+                if len(alternatives) < len(expressions):
+                    failed = _record_missed(
+                        pos, memo, missed.get(c, missed_default)
+                    )
+                    if expressions[-1] not in alternatives:
+                        retval = failed
+                return retval
+
+            return _match_terminals
 
         def _match(s: str, pos: int, memo: Memo) -> RawMatch:
-            _id = id(_match)
-
-            if memo and pos in memo and _id in memo[pos]:
-                # packrat memoization check
-                end, args, kwargs = memo[pos][_id]
-            else:
+            # packrat memoization check; results are never None
+            entries = memo.get(pos) if memo else None
+            retval = entries.get(_id) if entries else None
+            if retval is None:
                 # clear memo beyond size limit
                 if memo and len(memo) > MAX_MEMO_SIZE:
-                    for _pos in sorted(memo)[:DEL_MEMO_SIZE]:
-                        del memo[_pos]
-                for e in expressions:
+                    _trim_memo(memo)
+                alternatives: Sequence[_Matcher]
+                if table is None:
+                    alternatives = expressions
+                else:
+                    c = s[pos:pos+1]
+                    alternatives = table.get(c, default)
+                end = FAIL
+                for e in alternatives:
                     end, args, kwargs = e(s, pos, memo)
                     if end >= 0:
                         break
+                if end < 0 and len(alternatives) < len(expressions):
+                    failed = _record_missed(
+                        pos, memo, missed.get(c, missed_default)
+                    )
+                    if expressions[-1] not in alternatives:
+                        end, args, kwargs = failed
+                retval = end, args, kwargs  # end may be FAIL
                 if memo is not None:
-                    memo[pos][_id] = (end, args, kwargs)
+                    memo[pos][_id] = retval
 
-            return end, args, kwargs  # end may be FAIL
+            return retval
 
+        _id = id(_match)
         return _match
 
     def _repetition(
@@ -244,8 +430,11 @@ class PackratParser(Parser):
         return self._repetition(definition.args[0], 1, -1)
 
     def _optional(self, definition: Definition) -> _Matcher:
+        subdef: Definition = definition.args[0]
+        if subdef.op == Operator.BND:
+            return self._optional_bind(subdef)
 
-        expression = self._def_to_expr(definition.args[0])
+        expression = self._def_to_expr(subdef)
 
         def _match(s: str, pos: int, memo: Memo) -> RawMatch:
             end, args, kwargs = expression(s, pos, memo)
@@ -255,10 +444,28 @@ class PackratParser(Parser):
 
         return _match
 
+    def _optional_bind(self, definition: Definition) -> _Matcher:
+        """An optional binding; nothing is bound when it does not match."""
+        expression = self._def_to_expr(definition.args[0])
+        name: str = definition.args[1]
+
+        def _match(s: str, pos: int, memo: Memo) -> RawMatch:
+            end, args, kwargs = expression(s, pos, memo)
+            if end < 0:
+                return pos, (), None
+            if not kwargs:
+                kwargs = {}
+            kwargs[name] = args[0] if args else None  # inlined determine()
+            return end, (), kwargs
+
+        return _match
+
     def _lookahead(self, definition: Definition, polarity: bool) -> _Matcher:
         """An expression that may match but consumes no input."""
 
-        expression = self._def_to_expr(definition)
+        # the values of the expression are discarded, so captures and
+        # bindings in it are not built
+        expression = self._def_to_expr(_without_values(definition))
 
         def _match(s: str, pos: int, memo: Memo) -> RawMatch:
             end, args, kwargs = expression(s, pos, memo)
@@ -300,7 +507,7 @@ class PackratParser(Parser):
                 return FAIL, args, None
             if not kwargs:
                 kwargs = {}
-            kwargs[name] = determine(args)
+            kwargs[name] = args[0] if args else None  # inlined determine()
             return end, (), kwargs
 
         return _match
@@ -311,6 +518,18 @@ class PackratParser(Parser):
         name: str
         subdef, action, name = definition.args
         expression = self._def_to_expr(subdef)
+        if isinstance(action, Constant):
+            # the result is the same every time, so the action is not
+            # called, as for the operator tokens of the grammar parser
+            retval = (action.arg,)
+
+            def _match(s: str, pos: int, memo: Memo) -> RawMatch:
+                end, args, kwargs = expression(s, pos, memo)
+                if end < 0:
+                    return FAIL, args, None
+                return end, retval, None
+
+            return _match
         return Rule(name, expression, action)
 
     @staticmethod
@@ -333,6 +552,7 @@ class PackratParser(Parser):
     def _debug(self, definition: Definition) -> _Matcher:
         subdef: Definition = definition.args[0]
         expression = self._def_to_expr(subdef)
+        isatty = sys.stdout.isatty()
 
         def _match(s: str, pos: int, memo: Memo) -> RawMatch:
             # for proper printing, only terminals can print after
@@ -343,7 +563,7 @@ class PackratParser(Parser):
                 end, args, kwargs = expression(s, pos, memo)
                 indent = ' ' * len(inspect.stack(0))
                 color = 'green' if end >= 0 else 'red'
-                defstr = ansicolor(color, str(subdef))
+                defstr = ansicolor(color, str(subdef), isatty=isatty)
                 print(f'{snippet} | {indent}{defstr}')
             else:
                 print('{} | {}{!s}'.format(
@@ -357,8 +577,8 @@ class PackratParser(Parser):
 
     _op_map = {
         Operator.DOT: _terminal,
-        Operator.LIT: _terminal,
-        Operator.CLS: _terminal,
+        Operator.LIT: _literal,
+        Operator.CLS: _class,
         Operator.RGX: _terminal,
         # Operator.SYM: _,
         Operator.OPT: _optional,
@@ -385,6 +605,9 @@ class Rule:
     The *name* field is more relevant for the grammar than the rule
     itself, but it helps with debugging.
     """
+
+    __slots__ = 'name', 'expression', 'action'
+
     def __init__(self,
                  name: str,
                  expression: Optional[_Matcher] = None,
@@ -408,6 +631,249 @@ class Rule:
             raise NotImplementedError
 
 
+def _definition_order(defs: Dict[str, Definition]) -> List[str]:
+    """
+    Order the names in *defs* so each rule comes after the rules it
+    refers to, except where they refer back to it.
+    """
+    order: List[str] = []
+    seen: Set[str] = set()
+
+    def visit(name: str) -> None:
+        seen.add(name)
+        for ref in sorted(_references(defs[name])):
+            if ref in defs and ref not in seen:
+                visit(ref)
+        order.append(name)
+
+    for name in defs:
+        if name not in seen:
+            visit(name)
+    return order
+
+
+# Shared Subexpressions
+
+def _number_subexpressions(grammar: Grammar) -> Dict[int, int]:
+    """
+    Number the non-primary subexpressions of *grammar* by structure.
+
+    The grammar is flattened into a table of nodes, each an operator
+    followed by its arguments with subexpressions replaced by their
+    numbers, so equal subexpressions get the same number. The returned
+    mapping is from the id() of each subexpression to its number.
+    """
+    numbers: Dict[int, int] = {}
+    nodes: Dict[Tuple[Any, ...], int] = {}
+
+    def number(defn: Definition) -> Any:
+        n = numbers.get(id(defn))
+        if n is None:
+            node = (defn.op, *map(node_arg, defn.args))
+            try:
+                n = nodes.setdefault(node, len(nodes))
+            except TypeError:  # unhashable arguments are never shared
+                n = nodes[(id(defn),)] = len(nodes)
+            if defn.op.type != 'Primary':
+                numbers[id(defn)] = n
+        return n
+
+    def node_arg(arg: Any) -> Any:
+        if isinstance(arg, Definition):
+            return number(arg)
+        elif isinstance(arg, list):
+            return tuple(map(node_arg, arg))
+        return arg
+
+    for defn in grammar.definitions.values():
+        number(defn)
+    return numbers
+
+
+# First-character Dispatch
+
+_MAX_FIRST_CHARS = 256  # larger classes are not worth expanding
+
+
+def _dispatch_table(
+    items: List[Definition],
+    expressions: List[_Matcher],
+    defs: Dict[str, Definition],
+) -> Optional[Tuple[Dict[str, Tuple[_Matcher, ...]], Tuple[_Matcher, ...]]]:
+    """
+    Map each character that can start one of the choice's *items* to
+    the *expressions* to try, in order, and return the map with the
+    expressions to try for any other character.
+
+    Items that do not need to start with a particular character are
+    tried for every character. If there are only such items, `None` is
+    returned.
+    """
+    firsts = [_first_chars(defn, defs, set()) for defn in items]
+    known: Set[str] = set()
+    for chars in firsts:
+        if chars is not None:
+            known.update(chars)
+    if not known:
+        return None
+    table: Dict[str, List[_Matcher]] = {c: [] for c in known}
+    default: List[_Matcher] = []
+    for chars, expr in zip(firsts, expressions):
+        if chars is None:
+            default.append(expr)
+            for exprs in table.values():
+                exprs.append(expr)
+        else:
+            for c in chars:
+                table[c].append(expr)
+    return {c: tuple(exprs) for c, exprs in table.items()}, tuple(default)
+
+
+def _first_chars(
+    defn: Definition,
+    defs: Dict[str, Definition],
+    seen: Set[str],
+) -> Optional[Set[str]]:
+    """
+    Return the set of characters a match of *defn* must start with, or
+    `None` if it may match the empty string or start with anything.
+    """
+    chars, nullable = _first(defn, defs, seen)
+    return None if nullable else chars
+
+
+def _first(
+    defn: Definition,
+    defs: Dict[str, Definition],
+    seen: Set[str],
+) -> Tuple[Optional[Set[str]], bool]:
+    """
+    Return the set of characters a non-empty match of *defn* starts
+    with, or `None` if it may start with anything, and whether *defn*
+    may match the empty string.
+    """
+    op = defn.op
+    args = defn.args
+    if op == Operator.LIT:
+        return ({args[0][0]}, False) if args[0] else (set(), True)
+    elif op == Operator.CLS:
+        ranges, negate = args
+        if negate:
+            return None, False
+        chars: Set[str] = set()
+        for a, b in ranges:
+            chars.update(map(chr, range(ord(a), ord(b or a) + 1)))
+            if len(chars) > _MAX_FIRST_CHARS:
+                return None, False
+        return chars, False
+    elif op == Operator.SEQ:
+        # items that may match the empty string let the next one start
+        chars = set()
+        for d in args[0]:
+            _chars, nullable = _first(d, defs, seen)
+            if _chars is None:
+                return None, True
+            chars.update(_chars)
+            if not nullable:
+                return chars, False
+        return chars, True
+    elif op == Operator.CHC:
+        chars = set()
+        nullable = False
+        for d in args[0]:
+            _chars, _nullable = _first(d, defs, seen)
+            if _chars is None:
+                return None, True
+            chars.update(_chars)
+            nullable = nullable or _nullable
+        return chars, nullable
+    elif op in (Operator.OPT, Operator.STR):
+        return _first(args[0], defs, seen)[0], True
+    elif op in (Operator.PLS, Operator.CAP, Operator.BND, Operator.RUL):
+        return _first(args[0], defs, seen)
+    elif op == Operator.RPT:
+        first, nullable = _first(args[0], defs, seen)
+        return first, nullable or args[1] == 0
+    elif op == Operator.SYM:
+        name = args[0]
+        if name in seen or name not in defs:  # left-recursive or undefined
+            return None, True
+        return _first(defs[name], defs, seen | {name})
+    return None, True
+
+
+def _expected(
+    defn: Definition,
+    defs: Dict[str, Definition],
+    seen: FrozenSet[str] = frozenset(),
+) -> List[Definition]:
+    """
+    Return the expressions that fail when *defn* is tried on a
+    character it cannot start with, as those expressions report them.
+    """
+    op = defn.op
+    args = defn.args
+    if op == Operator.LIT and not args[0]:
+        return []
+    elif op in (Operator.LIT, Operator.CLS):
+        return [regex(defn)]  # as in PackratParser._terminal()
+    elif op == Operator.SEQ:
+        # items that may match the empty string let the next one fail
+        expected: List[Definition] = []
+        for d in args[0]:
+            expected.extend(_expected(d, defs, seen))
+            if not _first(d, defs, set(seen))[1]:
+                break
+        return expected
+    elif op == Operator.CHC:
+        return [x for d in args[0] for x in _expected(d, defs, seen)]
+    elif op in (Operator.OPT, Operator.STR, Operator.PLS, Operator.RPT,
+                Operator.CAP, Operator.BND, Operator.RUL):
+        return _expected(args[0], defs, seen)
+    elif op == Operator.SYM and args[0] in defs and args[0] not in seen:
+        return _expected(defs[args[0]], defs, seen | {args[0]})
+    else:
+        return [defn]
+
+
+def _skipped(
+    expected: List[Tuple[_Matcher, List[Definition]]],
+    tried: Sequence[_Matcher],
+) -> List[Tuple[int, Definition]]:
+    """
+    Return the memo keys and expected definitions of the alternatives
+    in *expected* that are not *tried*.
+    """
+    return [(id(defn), defn)
+            for expr, defns in expected if expr not in tried
+            for defn in defns]
+
+
+def _record_missed(
+    pos: int,
+    memo: Optional[Memo],
+    missed: Iterable[Tuple[int, Definition]],
+) -> RawMatch:
+    """
+    Record the failures of alternatives that were not tried at *pos*
+    and return the last one.
+    """
+    retval: RawMatch = (FAIL, (pos, None), None)
+    if memo is not None and len(memo) > MAX_MEMO_SIZE:
+        _trim_memo(memo)
+    for key, expected in missed:
+        retval = FAIL, (pos, expected), None
+        if memo is not None:
+            memo[pos][key] = retval
+    return retval
+
+
+def _trim_memo(memo: Memo) -> None:
+    """Drop the lowest positions from a memo that grew too large."""
+    for pos in sorted(memo)[:DEL_MEMO_SIZE]:
+        del memo[pos]
+
+
 def _get_furthest_fail(args, memo):
     failpos = -1
     message = 'failed to parse; use memoization for more details'
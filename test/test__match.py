@@ -17,6 +17,7 @@ OneTwoRule = Rule(Sequence(Capture(Literal('1')), Capture(Literal('2'))),
 def test_Match_atom():
     m = Match('123', 0, 1, One, (), {})
     assert m.string == '123'
+    assert m.pos == 0
     assert m.start() == 0
     assert m.end() == 1
     assert m.span() == (0, 1)
@@ -108,3 +109,12 @@ def test_Match_iterable_rule():
     assert m.groups() == (['1', '2'],)
     assert m.groupdict() == {}
     assert m.value() == ['1', '2']
+
+
+def test_Match_default_groups():
+    m = Match('123', 0, 1, One)
+    assert m.groups() == ()
+    assert m.groupdict() == {}
+    assert m.value() is None
+    m.groupdict()['x'] = 1  # returned dict is a copy
+    assert m.groupdict() == {}
@@ -1,4 +1,8 @@
 
+import sys
+
+import pytest
+
 import pe
 from pe.operators import (
     Literal,
@@ -8,10 +12,16 @@ from pe.operators import (
     Choice,
     Nonterminal,
     Capture,
+    Optional,
+    And,
+    Not,
+    Dot,
+    Star,
+    Rule,
 )
 from pe._grammar import Grammar
 from pe._parse import loads
-from pe._optimize import optimize
+from pe._optimize import optimize, compile_regex, retried, _without_values
 
 
 def gload(s, inline=False, common=False, regex=False):
@@ -56,6 +66,8 @@ def test_inline():
             gload(r'A <- "a" A  B <- "a" B'))
     assert (iload(r'A <- "a" B  B <- "b" A') ==
             gload(r'A <- "a" "b" A  B <- "b" "a" B'))
+    assert (iload(r'A <- B B  B <- C "b" A  C <- "c"') ==
+            gload(r'A <- "c" "b" A "c" "b" A  B <- "c" "b" B B  C <- "c"'))
 
     assert pe.compile('A <- "a" B  B <- "b"',
                       flags=pe.NONE).match('ab').value() is None
@@ -66,6 +78,20 @@ def test_inline():
     assert pe.compile('A <- "a" B  B <- ~"b"',
                       flags=pe.INLINE).match('ab').value() == 'b'
 
+    # empty sequences have no children to take from the other results
+    g = grm({'A': And(Choice(And(Class('a-b')), Sequence())),
+             'B': Sequence(Nonterminal('A'), Sequence())})
+    assert optimize(g, inline=True) == grm({
+        'A': And(Choice(Regex('(?=[a-b])'), Sequence())),
+        'B': And(Choice(Regex('(?=[a-b])'), Sequence())),
+    })
+    g = grm({'A': Optional(Choice(Capture(Dot()), Sequence())),
+             'B': Sequence(Nonterminal('A'), Sequence())})
+    assert optimize(g, inline=True, common=True) == grm({
+        'A': Optional(Choice(Capture(Regex('(?s:.)')), Sequence())),
+        'B': Optional(Choice(Capture(Regex('(?s:.)')), Sequence())),
+    })
+
 
 def test_common():
     assert (cload(r'A <- "a"') ==
@@ -89,6 +115,10 @@ def test_common():
     assert (cload(r'A <- !"a" .') ==
             cload(r'A <- ![a] .') ==
             grm({'A': Class('a', negate=True)}))
+    # including classes whose ranges are given as lists
+    assert (optimize(grm({'A': Sequence(Not(Class([['a', 'c']])), Dot())}),
+                     inline=False, common=True, regex=False) ==
+            grm({'A': Class('a-c', negate=True)}))
     # sequence of literals to literal
     assert (cload(r'A <- "a" "bc" "d"') ==
             gload(r'A <- "abcd"'))
@@ -98,6 +128,16 @@ def test_common():
     # but not sequence with multi-char classes
     assert (cload(r'A <- "a" [bc] "d"') ==
             gload(r'A <- "a" [bc] "d"'))
+    # repeated terminals after a repetition of the same terminals
+    assert (cload(r'A <- [ab]* [ab]* [ab]?') ==
+            gload(r'A <- [ab]*'))
+    assert (cload(r'A <- "a"+ "a"* "b"') ==
+            gload(r'A <- "a"+ "b"'))
+    # but not when the first could stop early
+    assert (cload(r'A <- "a"? "a"*') ==
+            gload(r'A <- "a"? "a"*'))
+    assert (cload(r'A <- "a"* "a"+') ==
+            gload(r'A <- "a"* "a"+'))
     # choice of classes
     assert (cload(r'A <- [ab] / [bc]') ==
             gload(r'A <- [abc]'))
@@ -138,6 +178,10 @@ def test_regex():
             grm({'A': Choice(
                 Regex(r'(?=(?P<_1>a*))(?P=_1)'),
                 Capture(Regex(r'b')))}))
+    assert (rload(r'A <- "ab"? "c"') ==
+            grm({'A': Regex(r'(?:ab)?c')}))
+    assert (rload(r'A <- "ab"+') ==
+            grm({'A': Regex(r'(?=(?P<_1>(?:ab)+))(?P=_1)')}))
 
 
 def test_regex_values():
@@ -164,3 +208,54 @@ def test_regex_not_dot():
             == grm({'A': Regex(r'[^abc]')}))
     assert (rload(r'A <- (![abc] .)*', common=True)
             == grm({'A': Regex(r'(?=(?P<_1>[^abc]*))(?P=_1)')}))
+
+
+@pytest.mark.parametrize('pattern,atomic,input,end', [
+    (r'(?=(?P<_1>a*))(?P=_1)a', r'(?>a*)a', 'aaa', None),
+    (r'(?=(?P<_1>ab|abc))(?P=_1)c', r'(?>ab|abc)c', 'abc', 3),
+    (r'(?=(?P<_2>(?:(?=(?P<_1>[bc]|d))(?P=_1))*))(?P=_2)',
+     r'(?>(?:(?>[bc]|d))*)', 'bdcx', 3),
+    (r'(?=(?P<_1>a))b|(?=(?P<_2>x))(?P=_2)',
+     r'(?=(?P<_1>a))b|(?>x)', 'x', 1),
+])
+def test_compile_regex(pattern, atomic, input, end):
+    # native atomic groups replace the emulated ones from Python 3.11
+    regex = compile_regex(pattern)
+    if sys.version_info >= (3, 11):
+        assert regex.pattern == atomic
+    else:
+        assert regex.pattern == pattern
+    m = regex.match(input)
+    assert (m.end() if m else None) == end
+
+
+def test_without_values():
+    _, defs = loads(r'A <- ~"a" (x:"b")* / B  B <- "c" ~"d"')
+    assert (_without_values(defs['A'])
+            == Choice(Sequence('a', Star('b')), Nonterminal('B')))
+    assert _without_values(defs['B']) == Sequence('c', 'd')
+    # rules keep their values for their actions
+    rule = Rule(Capture('a'), int)
+    assert _without_values(rule) is rule
+
+
+def test_retried():
+    def load(s):
+        return retried(loads(s)[1])
+    assert load(r'A <- B "x" / B "y"  B <- "b" "c"?') == {'B'}
+    assert load(r'A <- B / C  B <- "b"  C <- B "c"') == {'B'}
+    assert load(r'A <- B? B  B <- "b"') == {'B'}
+    assert load(r'A <- &B B  B <- "b"') == {'B'}
+    assert load(r'A <- B C "x" / B C "y"  B <- "b"*  C <- "c"') == {'B', 'C'}
+    # rules are not retried at the same position after input is consumed
+    assert load(r'A <- "a" B / "b" B  B <- "c"') == set()
+    assert load(r'A <- B ("," B)*  B <- [0-9]+') == set()
+    assert load(r'A <- B* "x"  B <- "b"') == set()
+    # regular expressions that match the empty string are nullable
+    defs = {'A': Choice(Sequence(Regex(',?'), Nonterminal('B')),
+                        Nonterminal('B')),
+            'B': Literal('b')}
+    assert retried(defs) == {'B'}
+    defs['A'] = Choice(Sequence(Regex(','), Nonterminal('B')),
+                       Nonterminal('B'))
+    assert retried(defs) == set()
@@ -1,6 +1,9 @@
+from collections import defaultdict
+import warnings
+
 import pytest
 
-from pe._errors import GrammarError
+from pe._errors import GrammarError, GrammarWarning
 from pe.operators import (
     Dot,
     Literal,
@@ -18,7 +21,7 @@ from pe.operators import (
     Bind,
     AutoIgnore,
 )
-from pe._parse import loads
+from pe._parse import loads, _get_parser
 
 
 def eloads(s):
@@ -137,6 +140,21 @@ def test_loads_def():
                    'Bee': Literal('b')})
 
 
+def test_loads_comments():
+    assert loads('# a\nA <- "a"  # b\r\n#c\rB <- "b" #d') == (
+        'A', {'A': Literal('a'), 'B': Literal('b')}
+    )
+
+
+def test_loads_repeated():
+    start1, defs1 = loads('A <- "a" B <- "b"')
+    start2, defs2 = loads('A <- "a" B <- "b"')
+    assert (start1, defs1) == (start2, defs2)
+    defs1['C'] = Literal('c')  # callers get their own mapping
+    assert 'C' not in defs2
+    assert loads('A <- "a" B <- "b"')[1] == defs2
+
+
 def test_loads_autoignore_def():
     assert loads('A <  "a"') == ('A', {'A': AutoIgnore('a')})
     assert loads('A <  ~"a"') == ('A', {'A': AutoIgnore(Capture('a'))})
@@ -151,3 +169,40 @@ def test_loads_error():
         loads('A <- +"a"')
     with pytest.raises(GrammarError):
         loads('A <- "a"+*')
+    with pytest.raises(GrammarError) as excinfo:
+        loads('A <- "a"\nB <<- "b"')
+    assert 'line 1, character 3' in str(excinfo.value.__cause__)
+
+
+def test_loads_error_warns_once():
+    with pytest.warns(GrammarWarning) as record:
+        with pytest.raises(GrammarError):
+            loads('A <- [a-] "b"')
+    assert len(record) == 1
+
+
+def test_loads_warns_each_time():
+    # loads that warn are not cached, so every load warns
+    for _ in range(2):
+        with pytest.warns(GrammarWarning):
+            assert loads('A <- [a-]]') == ('A', {'A': Class([('a', ']')])})
+
+
+def test_quiet_parser():
+    # the parser used to report failures does not warn
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        m = _get_parser(warn=False).match('A <- [a-]]')
+    with pytest.warns(GrammarWarning):
+        assert m.value() == _get_parser().match('A <- [a-]]').value()
+
+
+@pytest.mark.parametrize('s', ['\\n', '\\101', '\\x41', '\\u0041',
+                               '\\U00000041'])
+def test_char_escape_dispatch(s):
+    # only the escape starting with the character after the backslash
+    # is tried, so no failures are left after it
+    memo = defaultdict(dict)
+    end, _, _ = _get_parser()._exprs['Char'](s, 0, memo)
+    assert end == len(s)
+    assert all(entry[0] >= 0 for entry in memo[1].values())
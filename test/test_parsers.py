@@ -1,8 +1,11 @@
 
+from functools import partial
+from collections import defaultdict
+
 import pytest
 
 import pe
-from pe._constants import FAIL
+from pe._constants import FAIL, MAX_MEMO_SIZE, Operator
 from pe.operators import (
     Dot,
     Literal as Lit,
@@ -23,14 +26,19 @@ from pe.operators import (
     AutoIgnore as Ign,
 )
 from pe._grammar import Grammar
-from pe.actions import Pack
-from pe.packrat import PackratParser
+from pe._optimize import optimize as _optimize
+from pe._parse import PEG
+from pe.actions import Constant, Pack
+from pe.packrat import PackratParser, Rule
 from pe._py_machine import MachineParser as PyMachineParser
 try:
     from pe._cy_machine import MachineParser as CyMachineParser
 except ImportError:
     CyMachineParser = None
 
+SpecializedPackratParser = partial(PackratParser, flags=pe.SPECIALIZE)
+SpecializedPyMachineParser = partial(PyMachineParser, flags=pe.SPECIALIZE)
+
 
 # don't reuse these in value-changing operations like Bind
 abc = Cls('abc')
@@ -55,6 +63,8 @@ data = [  # noqa: E127
     ('Lit7', Lit('abc',),     'abcabc', 0, 3,    _blank),
     ('Lit8', Lit('abc',),     'abcabc', 1, FAIL, None),
     ('Lit9', Lit('abc',),     'abcabc', 3, 6,    _blank),
+    ('Lit10', Lit('λ',),      'aλ',     1, 2,    _blank),
+    ('Lit11', Lit('λ',),      'λ',      1, FAIL, None),
 
     ('Cls0', Cls('ab',),      'a',      0, 1,    _blank),
     ('Cls1', Cls('ab',),      'aa',     0, 1,    _blank),
@@ -64,6 +74,15 @@ data = [  # noqa: E127
     ('Cls5', Cls('a-c',),     'b',      0, 1,    _blank),
     ('Cls6', Cls('a-c-z',),   'e',      0, FAIL, None),
     ('Cls7', Cls('a-cd-z',),  'e',      0, 1,    _blank),
+    ('Cls8', Cls('a-zα-ω',),  'λ',      0, 1,    _blank),
+    ('Cls9', Cls('ab', negate=True),
+                              'c',      0, 1,    _blank),
+    ('Cls10', Cls('ab', negate=True),
+                              'a',      0, FAIL, None),
+    ('Cls11', Cls('ab', negate=True),
+                              'λ',      0, 1,    _blank),
+    ('Cls12', Cls('ab', negate=True),
+                              '',       0, FAIL, None),
 
     ('Rgx0', Rgx('a*'),       'aaa',    0, 3,    _blank),
     ('Rgx1', Rgx('a|b',),     'b',      0, 1,    _blank),
@@ -91,6 +110,15 @@ data = [  # noqa: E127
                               'aabbcc', 0, 3,    _blank),
     ('Rpt3', Rpt(abc, min=3), 'aaxx',   0, FAIL, None),
     ('Rpt4', Rpt(abc, max=1), 'aabbcc', 0, 1,    _blank),
+    ('Rpt5', Rpt(abseq, count=2),
+                              'ababab', 0, 4,    _blank),
+    ('Rpt6', Rpt(abseq, min=1, max=2),
+                              'ababab', 0, 4,    _blank),
+    ('Rpt7', Rpt(abseq, max=1),
+                              'ababab', 0, 2,    _blank),
+    ('Rpt8', Rpt(abc, max=1), 'd',      0, 0,    _blank),
+    ('Rpt9', Rpt(abc, min=2, max=3),
+                              'ad',     0, FAIL, None),
 
     ('And0', And(abc),        'a',      0, 0,    _blank),
     ('And1', And(abc),        'd',      0, FAIL, None),
@@ -102,6 +130,10 @@ data = [  # noqa: E127
                               'a',      0, 1,    ((), {'x': None}, None)),
     ('Bnd1', Bnd(Cap(Cls('abc')), name='x'),
                               'a',      0, 1,    ((), {'x': 'a'}, None)),
+    ('Bnd2', Opt(Bnd(Cap(Cls('abc')), name='x')),
+                              'a',      0, 1,    ((), {'x': 'a'}, None)),
+    ('Bnd3', Opt(Bnd(Cap(Cls('abc')), name='x')),
+                              'd',      0, 0,    _blank),
 
     ('Seq0', Seq(abc),        'aaa',    0, 1,    _blank),
     ('Seq1', Seq(abc, abc),   'bbb',    0, 2,    _blank),
@@ -142,6 +174,17 @@ data = [  # noqa: E127
                               'ab',     0, 2,    ((['a', 'b'],),
                                                   {},
                                                   ['a', 'b'])),
+    # actions and captures apply after every alternative
+    ('Rul6', Rul(Chc(Cap('x'), Cap('y')), action=Pack(list)),
+                              'x',      0, 1,    ((['x'],), {}, ['x'])),
+    ('Rul7', Rul(And('a'), Constant('A')),
+                              'a',      0, 0,    (('A',), {}, 'A')),
+    ('Rul8', Rul(Seq('a', Not('b')), Constant('A')),
+                              'ac',     0, 1,    (('A',), {}, 'A')),
+    ('Cap10', Cap(Seq('a', Chc('x', 'y'))),
+                              'ax',     0, 2,    (('ax',), {}, 'ax')),
+    ('Cap11', Seq(Cap(And('a')), 'a'),
+                              'a',      0, 1,    (('',), {}, '')),
 
     # Regression tests for Machine Parser
     ('Rgr0', Cap(Sym('abc')), 'a',      0, 1,    (('a',), {}, 'a')),
@@ -162,16 +205,42 @@ data = [  # noqa: E127
 
 ]
 
+# The machine parsers do not guard against repeating an expression that
+# matches the empty string, so these only run on the packrat parsers.
+# At most one repetition is allowed per remaining character.
+packrat_data = [  # noqa: E127
+    ('Nul0', Pls(And(Opt(Dot()))),
+                              '',       0, FAIL, None),
+    ('Nul1', Pls(And(Opt(Dot()))),
+                              'a',      0, 0,    _blank),
+    ('Nul2', Not(Pls(Not(Lit('c')))),
+                              '',       0, 0,    _blank),
+    ('Nul3', Not(Pls(Not(Lit('c')))),
+                              'a',      0, FAIL, None),
+    ('Nul4', Not(Pls(Not(Lit('c')))),
+                              'c',      0, 0,    _blank),
+]
+
 
 @pytest.mark.parametrize('parser,dfn,input,pos,end,match',
                          [(parser,) + row[1:]
                           for parser in [PackratParser,
+                                         SpecializedPackratParser,
                                          PyMachineParser,
+                                         SpecializedPyMachineParser,
                                          CyMachineParser]
-                          for row in data],
+                          for row in data]
+                         + [(parser,) + row[1:]
+                            for parser in [PackratParser,
+                                           SpecializedPackratParser]
+                            for row in packrat_data],
                          ids=[f'{parser}-{row[0]}'
-                              for parser in ['Packrat', 'Mach(p)', 'Mach(c)']
-                              for row in data])
+                              for parser in ['Packrat', 'Packrat(s)',
+                                             'Mach(p)', 'Mach(p,s)', 'Mach(c)']
+                              for row in data]
+                         + [f'{parser}-{row[0]}'
+                            for parser in ['Packrat', 'Packrat(s)']
+                            for row in packrat_data])
 def test_exprs(parser, dfn, input, pos, end, match):
     if parser is None:
         pytest.skip('extension module is not available')
@@ -188,6 +257,239 @@ def test_exprs(parser, dfn, input, pos, end, match):
         assert m.value() == value
 
 
+@pytest.mark.parametrize('dfn,input', [
+    (Seq('a', Pls('b'), 'c'), 'abz'),
+    (Chc('a', 'b', 'bc'), 'z'),
+    (Chc(Seq('a', 'b'), Seq('a', 'c'), Cls('a-c'), 'x'), 'z'),
+    (Seq(Str(Chc(Seq('a', Cls('0-9')), 'b')), 'c'), 'a1ba2bz'),
+    (Seq(Rpt(Cls('0-9'), min=2, max=3), Opt('x'), Dot()), '12x'),
+    (Seq(And(Cls('a-z')), Not('ab'), Rgx('[a-z]+'), 'c'), 'axz'),
+])
+def test_specialized_errors(dfn, input):
+    # specialized expressions report the same failing subexpressions
+    g = Grammar({'Start': dfn})
+    with pytest.raises(pe.ParseError) as expected:
+        PackratParser(g).match(input)
+    with pytest.raises(pe.ParseError) as actual:
+        SpecializedPackratParser(g).match(input)
+    assert str(actual.value) == str(expected.value)
+
+
+def test_literal_errors():
+    # literals are not matched with regular expressions, but they are
+    # reported as the same escaped pattern
+    g = Grammar({'Start': Seq('a', Lit('.*'))})
+    with pytest.raises(pe.ParseError) as excinfo:
+        PackratParser(g).match('a.')
+    assert str(excinfo.value).endswith('`\\.\\*`')
+    assert excinfo.value.offset == 1
+
+
+def test_forward_references():
+    # rules are built before the rules that refer to them, so only
+    # recursive references need a placeholder Rule
+    g = Grammar({'Start': Seq(Sym('A'), Sym('B')),
+                 'A': Lit('a'),
+                 'B': Chc(Seq('b', Sym('B')), 'c')})
+    p = PackratParser(g)
+    assert not isinstance(p._exprs['A'], Rule)
+    assert isinstance(p._exprs['B'], Rule)
+    assert p.match('abbc').end() == 4
+
+
+def test_constant_rules():
+    # rules with constant actions do not need a Rule object, even when
+    # referred to before they are built
+    g = Grammar({'Start': Seq(Sym('A'), Sym('B')),
+                 'A': Rul(Str('a'), Constant(1)),
+                 'B': Rul(Chc(Seq('b', Sym('B')), 'c'), Constant(2))})
+    p = PackratParser(g)
+    assert not isinstance(p._exprs['A'], Rule)
+    assert p.match('aabbc').groups() == (1, 2)
+    assert p.match('aabbd', flags=pe.MEMOIZE) is None
+
+
+def test_single_valued_sequence():
+    # the values of the only item that emits any are passed on as is
+    g = Grammar({'Start': Seq('(', Sym('A'), ')'),
+                 'A': Seq(Cap(Cls('a-z')), Bnd(Cap('x'), name='x')),
+                 'B': Seq('[', Bnd(Sym('A'), name='y'), ']')})
+    p = PackratParser(g)
+    memo = defaultdict(dict)
+    end, args, kwargs = p._exprs['Start']('(ax)', 0, memo)
+    assert (end, args, kwargs) == (4, ('a',), {'x': 'x'})
+    assert p._exprs['B']('[ax]', 0, memo)[1:] == ((), {'x': 'x', 'y': 'a'})
+
+
+def test_shared_subexpressions():
+    # equal subexpressions share a matcher, and so its memo entries
+    g = Grammar({'Start': Chc(Seq(Chc('a', Seq('b', 'c')), 'x'),
+                              Seq(Chc('a', Seq('b', 'c')), 'y'))})
+    p = PackratParser(g)
+    memo = defaultdict(dict)
+    assert p._exprs['Start']('bcy', 0, memo)[0] == 3
+    assert len(memo[0]) == 2  # one entry for each choice
+
+
+@pytest.mark.parametrize('flags', [pe.NONE, pe.SPECIALIZE])
+def test_memo_size(flags):
+    # failures recorded outside of choices also keep the memo bounded
+    g = Grammar({'Start': Seq(Str(Seq(Not('x'), Dot())), 'x')})
+    p = PackratParser(g, flags=flags)
+    memo = defaultdict(dict)
+    s = 'a' * (MAX_MEMO_SIZE * 4) + 'x'
+    assert p._exprs['Start'](s, 0, memo)[0] == len(s)
+    assert 0 < len(memo) <= MAX_MEMO_SIZE + 1
+    with pytest.raises(pe.ParseError) as excinfo:
+        p.match(s[:-1], flags=pe.MEMOIZE | pe.STRICT)
+    assert excinfo.value.offset == len(s) - 1
+
+
+@pytest.mark.parametrize('parser', [PyMachineParser, CyMachineParser])
+def test_large_programs(parser):
+    if parser is None:
+        pytest.skip('extension module is not available')
+    # instruction locations and repetition counts may exceed 2**15
+    n = 10_000
+    defs = {f'R{i}': Chc(Seq('a', Sym(f'R{i + 1}')), 'b') for i in range(n)}
+    defs[f'R{n}'] = Lit('c')
+    defs['Start'] = Seq(Sym('R0'), Rpt(Seq('x', 'y'), max=40_000))
+    p = parser(Grammar(defs))
+    assert p.match('aaab').end() == 4
+    assert p.match('b' + 'xy' * 40_001).end() == 80_001
+
+
+@pytest.mark.parametrize('parser', [PyMachineParser, CyMachineParser])
+def test_deep_stacks(parser):
+    if parser is None:
+        pytest.skip('extension module is not available')
+    # the backtracking stack grows well past its initial size
+    g = Grammar({'Start': Chc(Seq('a', Sym('Start')), 'b')})
+    p = parser(g)
+    for _ in range(2):
+        assert p.match('a' * 5_000 + 'b').end() == 5_001
+        assert p.match('a' * 5_000 + 'c', flags=pe.NONE) is None
+
+
+@pytest.mark.parametrize('flags', [pe.NONE, pe.MEMOIZE])
+def test_specialized_machine(flags):
+    # the generated program matches like the interpreted one
+    g = Grammar({'Start': Pls(Chc(Seq(Sym('Item'), ';'), Seq(Sym('Item'), ','))),
+                 'Item': Seq(Bnd(Cap(Pls(abc)), name='x'), Opt(Sym('Num'))),
+                 'Num': Rul(Cap(Rpt(Cls('0-9'), min=1, max=2)), int)})
+    expected = PyMachineParser(g)
+    actual = SpecializedPyMachineParser(g)
+    for s in ['a1,bc;', 'ab12;ca123,', 'a;bx', '']:
+        m1 = expected.match(s, flags=flags)
+        m2 = actual.match(s, flags=flags)
+        if m1 is None:
+            assert m2 is None
+        else:
+            assert m2.end() == m1.end()
+            assert m2.groups() == m1.groups()
+            assert m2.groupdict() == m1.groupdict()
+
+
+@pytest.mark.parametrize('parser', [PyMachineParser,
+                                    SpecializedPyMachineParser,
+                                    CyMachineParser])
+def test_machine_memoize(parser):
+    if parser is None:
+        pytest.skip('extension module is not available')
+    # memoized rules give the same values as in the packrat parser,
+    # including bindings made in a rule called from several places
+    g = Grammar({'Start': Chc(Seq(Sym('Item'), ';', Sym('Num')),
+                              Seq(Sym('Item'), ',', Sym('Item')),
+                              Seq(Sym('Item'), Sym('Num'))),
+                 'Item': Seq(Bnd(Cap(Pls(abc)), name='x'), Opt(Sym('Num'))),
+                 'Num': Rul(Cap(Rpt(Cls('0-9'), min=1, max=2)), int)})
+    expected = PackratParser(g)
+    actual = parser(g)
+    for s in ['a1;2', 'ab12,ca3', 'b1234', 'bc4', 'ab,c', 'a;b', '']:
+        m1 = expected.match(s, flags=pe.MEMOIZE)
+        m2 = actual.match(s, flags=pe.MEMOIZE)
+        if m1 is None:
+            assert m2 is None
+        else:
+            assert m2.end() == m1.end()
+            assert m2.groups() == m1.groups()
+            assert m2.groupdict() == m1.groupdict()
+
+
+@pytest.mark.parametrize('parser', [PyMachineParser,
+                                    SpecializedPyMachineParser])
+def test_machine_memo_entries(parser):
+    # memoized rules store empty values without slicing the value stacks
+    g = Grammar({'Start': Chc(Seq(Sym('A'), Sym('B'), 'x'),
+                              Seq(Sym('A'), Sym('B'), 'y')),
+                 'A': Pls('a'),
+                 'B': Bnd(Cap('b'), name='b')})
+    p = parser(g)
+    memo = defaultdict(dict)
+    end = p._match(p.pi, p._start_idx, 'aby', 0, [], [], memo, p._memoized)
+    assert end == 3
+    assert sorted(memo[0].values()) == [(1, (), None)]
+    assert sorted(memo[1].values()) == [(2, (), {'b': 'b'})]
+
+
+@pytest.mark.parametrize('parser', [PyMachineParser,
+                                    SpecializedPyMachineParser,
+                                    CyMachineParser])
+def test_machine_memo_size(parser):
+    if parser is None:
+        pytest.skip('extension module is not available')
+    # only rules tried again at the same position are memoized, and the
+    # memo is trimmed like the packrat parser's
+    g = Grammar({'Start': Str(Chc(Seq(Sym('A'), 'x'), Seq(Sym('A'), 'y'))),
+                 'A': Seq('a', Opt(Cap('b')))})
+    p = parser(g)
+    assert p._memoized == {p._index['A']}
+    s = 'ay' * (MAX_MEMO_SIZE * 2)
+    if parser is CyMachineParser:
+        memo = {}
+        end = p._parser.match(p._start_idx, s, 0, [], [], memo)
+    else:
+        memo = defaultdict(dict)
+        end = p._match(p.pi, p._start_idx, s, 0, [], [], memo, p._memoized)
+    assert end == len(s)
+    assert 0 < len(memo) <= MAX_MEMO_SIZE + 1
+    assert p.match(s, flags=pe.MEMOIZE).end() == len(s)
+    # grammars without such rules do not use a memo
+    g = Grammar({'Start': Str(Sym('A')), 'A': Seq('a', Opt(Cap('b')))})
+    assert parser(g)._memoized == set()
+
+
+@pytest.mark.parametrize('parser', [PyMachineParser, CyMachineParser])
+def test_machine_peg_grammar(parser):
+    if parser is None:
+        pytest.skip('extension module is not available')
+    # rules of the PEG grammar end in choices and lookaheads
+    flags = pe.INLINE | pe.COMMON
+    expected = PackratParser(PEG, flags=flags)
+    actual = parser(PEG, flags=flags)
+    for s in ['A <- &"a" "b"', 'A <- ~"a"+ / !B  B <- "b"?', 'A <- x:[a-c]*']:
+        assert actual.match(s).value() == expected.match(s).value()
+
+
+@pytest.mark.skipif(CyMachineParser is None,
+                    reason='extension module is not available')
+def test_cy_machine_regex():
+    flags = pe.INLINE | pe.COMMON | pe.REGEX
+    # the start rule becomes one regex
+    g = Grammar({'Start': Seq(Sym('A'), '-', Sym('A')), 'A': Pls(abc)})
+    p = CyMachineParser(g, flags=flags)
+    assert p.modified_grammar == PyMachineParser(g, flags=flags).modified_grammar
+    assert p.modified_grammar['Start'].op == Operator.RGX
+    assert p.match('abc-ba').end() == 6
+    assert p.match('abc-') is None
+    # the start rule does not, so regexes are not used
+    g = Grammar({'Start': Seq(Sym('A'), '-', Sym('A')), 'A': Rul(Cap(Pls(abc)), len)})
+    p = CyMachineParser(g, flags=flags)
+    assert p.modified_grammar == _optimize(g, regex=False)
+    assert p.match('abc-ba').groups() == (3, 2)
+    assert p.match('abc-') is None
+
+
 def test_snippet_escaping():
     input = "😊\nあ\rA\vB\tC\fD\u0085E\u2028F\u2029"
     output = r"😊\nあ\rA\vB\tC\fD\u0085E\u2028F\u2029"
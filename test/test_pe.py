@@ -4,6 +4,7 @@ import pytest
 import pe
 from pe.packrat import PackratParser
 from pe.machine import MachineParser
+from pe._functions import _compile_pattern
 
 
 def test_compile_default():
@@ -32,6 +33,16 @@ def test_match():
     assert not pe.match(r'"a"', 'b')
 
 
+def test_match_cached():
+    pe.match(r'"a" "b"', 'ab')
+    hits = _compile_pattern.cache_info().hits
+    assert pe.match(r'"a" "b"', 'ab')
+    assert _compile_pattern.cache_info().hits == hits + 1
+    # parsers with actions are not reused
+    assert pe.match(r'~"1"', '1', actions={'Start': int}).value() == 1
+    assert pe.match(r'~"1"', '1').value() == '1'
+
+
 def test_match_strict():
     assert pe.match(r'"a"', 'a', flags=pe.STRICT)
     with pytest.raises(pe.ParseError):
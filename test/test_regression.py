@@ -2,6 +2,17 @@
 import pytest
 
 import pe
+from pe._grammar import Grammar
+from pe.operators import (
+    Literal,
+    Class,
+    Sequence,
+    Choice,
+    Nonterminal,
+    And,
+    Not,
+    Dot,
+)
 
 
 @pytest.mark.parametrize('parser', ['packrat', 'machine', 'machine-python'])
@@ -40,3 +51,134 @@ def test_capture_repeated(parser):
     m3 = pe.match('(~"a")+', 'aaa', parser=parser)
     assert m3.group() == 'aaa'
     assert m3.groups() == ('a', 'a', 'a')
+
+
+@pytest.mark.parametrize('parser', ['packrat', 'machine', 'machine-python'])
+def test_reused_parser(parser):
+    p = pe.compile(r'A <- ~("a" / "b") "c" / ~"b" "d"', parser=parser)
+    assert p.match('ac').groups() == ('a',)
+    assert p.match('bd').groups() == ('b',)
+    assert p.match('bc').groups() == ('b',)
+    assert p.match('ad', flags=pe.MEMOIZE) is None
+
+
+@pytest.mark.parametrize('parser', ['packrat', 'machine', 'machine-python'])
+def test_choice_shared_first_character(parser):
+    p = pe.compile(r'A <- "ab" / "ac" / [a-c] "d" / B  B <- "x"+',
+                   parser=parser)
+    assert p.match('ab').end() == 2
+    assert p.match('ac').end() == 2
+    assert p.match('ad').end() == 2
+    assert p.match('bd').end() == 2
+    assert p.match('xx').end() == 2
+    assert p.match('yd', flags=pe.MEMOIZE) is None
+
+
+def test_choice_dispatch_errors():
+    # alternatives that cannot start with the next character are not
+    # tried, but they are reported as if they had failed there
+    p = pe.compile(r'A <- "ab" / "c" / [0-9] "d" / B  B <- "x"+',
+                   parser='packrat', flags=pe.NONE)
+    with pytest.raises(pe.ParseError) as exc:
+        p.match('y')
+    assert str(exc.value).endswith('`ab`, `c`, `[0-9]`, `x`, `x`')
+    # the same when only some alternatives are skipped
+    p = pe.compile(r'A <- "ab" / ![y] . "c" / "b"',
+                   parser='packrat', flags=pe.NONE)
+    with pytest.raises(pe.ParseError) as exc:
+        p.match('y')
+    assert str(exc.value).endswith('`ab`, `b`, `b`')
+    # and for alternatives that start with optional expressions
+    p = pe.compile(r'A <- ("x" / "y"?) "b" / "c"',
+                   parser='packrat', flags=pe.NONE)
+    with pytest.raises(pe.ParseError) as exc:
+        p.match('z')
+    assert str(exc.value).endswith('`x`, `y`, `b`, `c`, `c`')
+
+
+@pytest.mark.parametrize('parser', ['packrat', 'machine', 'machine-python'])
+def test_choice_unknown_first_character(parser):
+    # !"y" . and "z"? do not start with a particular character
+    p = pe.compile(r'A <- "ab" / !"y" . "c" / "b" / "z"? "d"',
+                   parser=parser)
+    assert p.match('ab').end() == 2
+    assert p.match('ac').end() == 2
+    assert p.match('b').end() == 1
+    assert p.match('bc').end() == 2
+    assert p.match('zd').end() == 2
+    assert p.match('d').end() == 1
+    assert p.match('yd', flags=pe.MEMOIZE) is None
+
+
+@pytest.mark.parametrize('parser', ['packrat', 'machine', 'machine-python'])
+def test_choice_optional_first_character(parser):
+    p = pe.compile(r'A <- "-"? [0-9] / "x"* "b" / ("y" / "z"?) "c" / "d"',
+                   parser=parser, flags=pe.NONE)
+    for s in ('-1', '1', 'xxb', 'b', 'yc', 'zc', 'c', 'd'):
+        assert p.match(s).end() == len(s)
+    assert p.match('e', flags=pe.MEMOIZE) is None
+
+
+@pytest.mark.parametrize('parser', ['packrat', 'machine', 'machine-python'])
+def test_choice_empty_alternative(parser):
+    # empty sequences match without starting with a particular character
+    g = Grammar(
+        {'A': Choice(Class('c'), Literal(''), Sequence()),
+         'B': Sequence(Choice(Literal('a'), Nonterminal('E')), Literal('b')),
+         'C': And(Choice(And(Class('a-b')), Sequence())),
+         'E': Sequence()},
+        start='A',
+    )
+    for flags in (pe.NONE, pe.INLINE, pe.OPTIMIZE):
+        p = pe.compile(g, parser=parser, flags=flags)
+        assert p.match('c').end() == 1
+        assert p.match('x').end() == 0
+    g = Grammar(g.definitions, start='B')
+    for flags in (pe.NONE, pe.INLINE, pe.OPTIMIZE):
+        p = pe.compile(g, parser=parser, flags=flags)
+        assert p.match('ab').end() == 2
+        assert p.match('b').end() == 1
+    g = Grammar(g.definitions, start='C')
+    for flags in (pe.NONE, pe.INLINE, pe.OPTIMIZE):
+        p = pe.compile(g, parser=parser, flags=flags)
+        assert p.match('').end() == 0
+
+
+@pytest.mark.parametrize('parser', ['packrat', 'machine', 'machine-python'])
+def test_sequence_of_terminals(parser):
+    # adjacent terminals around choices, repeats, and captures
+    p = pe.compile(r'A <- ("a" / "b") "c" [0-9] . ("d" "e")* ~("f" "g") "h"?',
+                   parser=parser, flags=pe.NONE)
+    assert p.match('ac1xfg').end() == 6
+    assert p.match('ac1xfg').value() == 'fg'
+    assert p.match('bc1xdedefgh').end() == 11
+    assert p.match('ac1xdfg', flags=pe.NONE) is None
+    assert p.match('acx', flags=pe.NONE) is None
+
+
+@pytest.mark.parametrize('parser', ['packrat', 'machine', 'machine-python'])
+def test_memoized_rule_values(parser):
+    # B is retried at the same position by each alternative of A
+    p = pe.compile(r'''
+        A <- B "x" / B "y" / B
+        B <- ~"b"+ n:(~"c")
+    ''', parser=parser, flags=pe.NONE)
+    for flags in (pe.NONE, pe.MEMOIZE):
+        m = p.match('bbcy', flags=flags)
+        assert m.end() == 4
+        assert m.groups() == ('bb',)
+        assert m.groupdict() == {'n': 'c'}
+        assert p.match('bc', flags=flags).end() == 2
+        assert p.match('by', flags=flags) is None
+
+
+@pytest.mark.parametrize('parser', ['packrat', 'machine', 'machine-python'])
+@pytest.mark.parametrize('flags', [pe.NONE, pe.REGEX, pe.COMMON, pe.OPTIMIZE])
+def test_class_list_ranges(parser, flags):
+    # ranges given as lists instead of tuples
+    g = Grammar({'Start': Sequence(Class([['a', 'c'], ['x', None]]),
+                                   Not(Class([['a', 'c']])), Dot())})
+    p = pe.compile(g, parser=parser, flags=flags)
+    assert p.match('bz').end() == 2
+    assert p.match('xz').end() == 2
+    assert p.match('ba', flags=pe.NONE) is None